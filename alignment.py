@@ -0,0 +1,116 @@
+"""Searching the best cue points and phase for a transition between two tempo-matched tracks."""
+
+import numpy as np
+
+from features import onset_envelope
+from instrumentation import span
+
+
+def envelope(track, kind="onset", window_size=1024, hop_length=512):
+    """
+    Frame-level onset or RMS envelope of a track.
+
+    Both are computed the way features.compute_features() does, so every track is
+    measured alike. The column stored in the track's features is used when it has the
+    same frames, otherwise the envelope is computed from the track's audio.
+    """
+    features = track.features
+    if features is not None and features["window_size"] == window_size and features["hop_length"] == hop_length:
+        return np.asarray(features[kind], dtype=np.float32)
+
+    if kind == "onset":
+        return onset_envelope(track.audio, track.sr, window_size=window_size, hop_length=hop_length)
+
+    import librosa
+
+    return librosa.feature.rms(y=np.asarray(track.audio), frame_length=window_size, hop_length=hop_length)[0]
+
+
+def _windows(env, starts, length):
+    """Cut windows of `length` frames starting at `starts`, zero-padded past either end."""
+    padded = np.concatenate((np.zeros(length, dtype=np.float32), env, np.zeros(length, dtype=np.float32)))
+    starts = np.clip(np.asarray(starts) + length, 0, len(padded) - length)
+    return padded[starts[:, np.newaxis] + np.arange(length)]
+
+
+def _standardise(windows):
+    windows = windows - windows.mean(axis=1, keepdims=True)
+    norm = np.linalg.norm(windows, axis=1, keepdims=True)
+    # Silent windows score zero against everything
+    return windows / np.maximum(norm, 1e-9)
+
+
+def alignment_scores(envelope_a, cues_a, envelope_b, cues_b, beat_period, frame_rate,
+                     window_beats=32, max_lag_beats=4):
+    """
+    Score every pairing of cue points at every beat-grid offset.
+
+    The incoming track's envelope from each of its cue points is cross-correlated with
+    the outgoing track's envelope around each of its cue points. Every window is
+    transformed once and all pairs are correlated in one batched FFT.
+
+    Args:
+        envelope_a: Envelope of the outgoing track.
+        cues_a: Candidate cue points of the outgoing track in seconds.
+        envelope_b: Envelope of the tempo-matched incoming track, same frame rate.
+        cues_b: Candidate cue points of the incoming track in seconds.
+        beat_period: Length of a beat in seconds, after tempo matching.
+        frame_rate: Envelope frames per second.
+        window_beats: Length of the transition window in beats.
+        max_lag_beats: Largest shift of the incoming track, in whole beats either way.
+
+    Returns:
+        A tuple (scores, lags). scores[i, j, k] is the normalised correlation when
+        cues_b[j] plays at cues_a[i] + lags[k]. lags are in seconds.
+    """
+    window = int(round(window_beats * beat_period * frame_rate))
+    beat_lags = np.arange(-max_lag_beats, max_lag_beats + 1)
+    lag_frames = np.round(beat_lags * beat_period * frame_rate).astype(int)
+    margin = int(lag_frames.max())
+
+    frames_a = np.round(np.asarray(cues_a) * frame_rate).astype(int)
+    frames_b = np.round(np.asarray(cues_b) * frame_rate).astype(int)
+
+    # The outgoing window reaches `margin` frames further on both sides so every lag fits
+    windows_a = _standardise(_windows(envelope_a, frames_a - margin, window + 2 * margin))
+    windows_b = _standardise(_windows(envelope_b, frames_b, window))
+
+    n_fft = 1 << int(np.ceil(np.log2(2 * (window + margin))))
+    spectra_a = np.fft.rfft(windows_a, n_fft)
+    spectra_b = np.conj(np.fft.rfft(windows_b, n_fft))
+
+    # correlation[i, j, m] = sum_t a_i[m + t] * b_j[t], offset m = margin + lag
+    correlation = np.fft.irfft(spectra_a[:, np.newaxis, :] * spectra_b[np.newaxis, :, :], n_fft)
+    scores = correlation[:, :, margin + lag_frames]
+
+    return scores, beat_lags * beat_period
+
+
+def find_alignment(track_a, track_b, cues_a=None, cues_b=None, kind="onset", window_size=1024, hop_length=512,
+                   **params):
+    """
+    Find the cue points and phase of the best transition from track_a into track_b.
+
+    Args:
+        track_a: The outgoing Track.
+        track_b: The incoming Track, already tempo-matched to track_a.
+        cues_a: Candidate cue points of track_a, defaults to its cue_points_rms.
+        cues_b: Candidate cue points of track_b, defaults to its cue_points_rms.
+        kind: Envelope to correlate, "onset" or "rms".
+        window_size: Frame length of the envelopes.
+        hop_length: Hop of the envelopes.
+        **params: Forwarded to alignment_scores().
+
+    Returns:
+        A tuple (acue, bcue, lag): track_b's bcue should play at acue + lag of track_a.
+    """
+    cues_a = np.asarray(track_a.cue_points_rms if cues_a is None else cues_a)
+    cues_b = np.asarray(track_b.cue_points_rms if cues_b is None else cues_b)
+
+    with span("alignment.find_alignment", pairs=len(cues_a) * len(cues_b)):
+        scores, lags = alignment_scores(envelope(track_a, kind, window_size, hop_length), cues_a,
+                                        envelope(track_b, kind, window_size, hop_length), cues_b,
+                                        60 / track_a.tempo, track_a.sr / hop_length, **params)
+        i, j, k = np.unravel_index(np.argmax(scores), scores.shape)
+
+    return float(cues_a[i]), float(cues_b[j]), float(lags[k])
@@ -0,0 +1,242 @@
+"""
+End-to-end benchmark of the analysis and mixing pipeline on synthetic tracks.
+
+Generates kick/click tracks at known tempos, times every stage separately and reports
+each as a multiple of realtime together with its peak traced memory. Results are saved
+as JSON so runs can be compared with --compare.
+
+    python benchmark.py --duration 300 --output bench.json
+    python benchmark.py --duration 300 --output new.json --compare bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+SR = 44100
+
+
+def synthetic_track(bpm, duration, sr=SR, seed=0):
+    """
+    Generate a four-on-the-floor test track.
+
+    Every beat has a kick, the first beat of each bar is accented, off-beats get a
+    noise click and every 16 bars a bass line toggles, so RMS changes land on known beats.
+
+    Returns:
+        A tuple (audio, beats) with the float32 signal and the true beat times.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * sr)
+    audio = np.zeros(n, dtype=np.float32)
+
+    beat_period = 60 / bpm
+    beats = np.arange(0, duration - beat_period, beat_period)
+
+    # Kick: a decaying sine sweep from 150 Hz down to 50 Hz
+    t = np.arange(int(0.25 * sr)) / sr
+    kick = (np.sin(2 * np.pi * (50 * t + 100 * (1 - np.exp(-t * 30)) / 30)) * np.exp(-t * 12)).astype(np.float32)
+    click = (rng.standard_normal(int(0.02 * sr)) * np.exp(-np.arange(int(0.02 * sr)) / 150)).astype(np.float32)
+
+    for i, beat in enumerate(beats):
+        start = int(beat * sr)
+        gain = 0.9 if i % 4 == 0 else 0.6
+        piece = kick[:n - start]
+        audio[start:start + len(piece)] += gain * piece
+
+        off = int((beat + beat_period / 2) * sr)
+        if off < n:
+            piece = click[:n - off]
+            audio[off:off + len(piece)] += 0.2 * piece
+
+    # Bass line on every other 16-bar section
+    section = int(16 * 4 * beat_period * sr)
+    bass = 0.25 * np.sin(2 * np.pi * 55 * np.arange(n) / sr).astype(np.float32)
+    for start in range(section, n, 2 * section):
+        audio[start:start + section] += bass[start:start + section]
+
+    return audio / np.max(np.abs(audio)), beats
+
+
+def run_stage(results, name, duration, func, *args, **kwargs):
+    """Run one stage, record its time, realtime factor and peak memory, and return its result."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except ImportError as e:
+        # A backend that is not installed skips the stage instead of failing the run
+        tracemalloc.stop()
+        results[name] = {"skipped": str(e)}
+        print(f"{name:<32} skipped ({e})")
+        return None
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results[name] = {
+        "seconds": elapsed,
+        "realtime": duration / elapsed if elapsed > 0 else float("inf"),
+        "peak_mb": peak / 2**20,
+    }
+    print(f"{name:<32} {elapsed:8.3f} s {results[name]['realtime']:10.1f}x realtime {peak / 2**20:9.1f} MB")
+    return result
+
+
+def import_time(module):
+    """Time a cold import of a project module in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output.stdout)
+
+
+def import_backends():
+    """
+    Import the audio backends and run each once on a tiny signal.
+
+    The first librosa call also compiles its numba kernels, which would otherwise be
+    charged to whichever stage happens to run first. Returns the seconds it took.
+    """
+    start = time.perf_counter()
+    import librosa
+    import scipy.signal  # noqa: F401
+    import soundfile as sf
+
+    for backend in ("madmom", "essentia.standard"):
+        try:
+            __import__(backend)
+        except ImportError:
+            # The stages using it are skipped later on
+            pass
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # A short file at another rate goes through the same decode and resample path as the tracks
+        path = os.path.join(tmp, "warm_up.wav")
+        sf.write(path, np.zeros(SR // 2, dtype=np.float32), SR // 2)
+        audio, _ = librosa.load(path, sr=SR, mono=True, dtype=np.float32)
+    librosa.feature.rms(y=audio)
+    return time.perf_counter() - start
+
+
+def run(duration=300, bpm=128, slave_bpm=124):
+    """Run every stage once on two synthetic tracks and return the results dict."""
+    import eq
+    import mixing
+    import preprocessing
+    import tempo
+    from track import Track
+
+    stages = {}
+    seconds = import_time("track")
+    stages["import_track"] = {"seconds": seconds}
+    print(f"{'import_track':<32} {seconds:8.3f} s")
+
+    # Cold backend imports are reported on their own, not inside the first stage timed
+    seconds = import_backends()
+    stages["import_backends"] = {"seconds": seconds}
+    print(f"{'import_backends':<32} {seconds:8.3f} s")
+
+    master_audio, master_beats = synthetic_track(bpm, duration, seed=0)
+    slave_audio, _ = synthetic_track(slave_bpm, duration, seed=1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        import soundfile as sf
+
+        master_file = os.path.join(tmp, "master.wav")
+        slave_file = os.path.join(tmp, "slave.wav")
+        sf.write(master_file, master_audio, SR)
+        sf.write(slave_file, slave_audio, SR)
+
+        def decode(path):
+            return Track(os.path.basename(path), path).audio
+
+        audio = run_stage(stages, "decode", duration, decode, master_file)
+        if audio is None:
+            audio = master_audio
+        slave = run_stage(stages, "decode_slave", duration, decode, slave_file)
+        if slave is None:
+            slave = slave_audio
+
+        run_stage(stages, "detect_downbeats", duration, preprocessing.detect_downbeats, audio, SR)
+        beats = run_stage(stages, "calculate_beats_multifeature", duration,
+                          preprocessing.calculate_beats_multifeature, audio)
+        if beats is None:
+            # Fall back to the known grid so the later stages still run
+            beats = master_beats
+
+        run_stage(stages, "calculate_rms_transitions_indices", duration,
+                  preprocessing.calculate_rms_transitions_indices, audio, SR, beats)
+
+        run_stage(stages, "rapid_eq", duration, eq.rapid_eq, audio, SR, [[1, 1], [0.2, 1]], [0, duration / 2])
+        run_stage(stages, "smooth_eq", duration, eq.smooth_eq, audio, SR,
+                  [[1, 1], [1, 1], [1, 0.7], [1, 0.1]], [0, duration / 4, duration / 2, duration * 3 / 4])
+
+        stretched = run_stage(stages, "adjust_tempo_pyrb", duration, tempo.adjust_tempo_pyrb,
+                              slave, SR, os.path.join(tmp, "stretched.wav"), bpm / slave_bpm)
+        if stretched is None:
+            stretched = slave
+        else:
+            stretched = stretched[0]
+
+        combined = run_stage(stages, "combine_tracks", duration, mixing.combine_tracks,
+                             audio, stretched, duration / 2, 0, SR)
+        if combined is not None:
+            run_stage(stages, "normalize_audio_gain", len(combined) / SR, eq.normalize_audio_gain, combined)
+
+        decks = mixing.transition_decks(audio, stretched, duration / 2, 0, SR)
+        run_stage(stages, "render_mix", duration, mixing.render_mix, decks, os.path.join(tmp, "mix.wav"), SR)
+
+    return {
+        "meta": {
+            "duration": duration,
+            "bpm": bpm,
+            "slave_bpm": slave_bpm,
+            "sr": SR,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": stages,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10),
+    }
+
+
+def compare(results, baseline):
+    """Print the speed-up of every stage relative to a previous run."""
+    print()
+    print(f"{'stage':<32} {'before':>10} {'after':>10} {'speed-up':>10}")
+    for name, after in results["stages"].items():
+        before = baseline["stages"].get(name, {})
+        if "seconds" in after and "seconds" in before:
+            print(f"{name:<32} {before['seconds']:9.3f}s {after['seconds']:9.3f}s "
+                  f"{before['seconds'] / after['seconds']:9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the AI-DJ pipeline on synthetic tracks.")
+    parser.add_argument("--duration", type=float, default=300, help="length of the test tracks in seconds")
+    parser.add_argument("--bpm", type=float, default=128, help="tempo of the master track")
+    parser.add_argument("--slave-bpm", type=float, default=124, help="tempo of the track that gets stretched")
+    parser.add_argument("--output", default="bench.json", help="where to save the results")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = run(args.duration, args.bpm, args.slave_bpm)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
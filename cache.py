@@ -0,0 +1,161 @@
+"""On-disk cache of track analysis results."""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+# Bump when the analysis code changes in a way that makes old entries wrong
+ANALYSIS_VERSION = 1
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def analysis_key(content_hash, **params):
+    """Build a cache key from a file's content hash and the analysis parameters."""
+    params_repr = ",".join(f"{name}={params[name]!r}" for name in sorted(params))
+    key = f"{ANALYSIS_VERSION}:{content_hash}:{params_repr}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Content-addressed store of preprocess() results, one pickle file per entry.
+
+    It can also hold the decoded audio of each file as a .npy file, so tracks can be
+    memory-mapped instead of decoded again, and per-track feature columns stored the
+    same way.
+    """
+
+    def __init__(self, directory=".analysis-cache"):
+        self.directory = directory
+
+    def _path(self, key):
+        # Shard on the first two hex digits so no single folder gets huge
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def get(self, key):
+        """Return the cached analysis dict for a key, or None on a miss."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # A truncated or corrupt entry is treated as a miss and rewritten
+            return None
+
+    def put(self, key, analysis):
+        """Store an analysis dict under a key."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(analysis, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _audio_path(self, content_hash, sr):
+        return os.path.join(self.directory, "audio", f"{content_hash}_{sr}.npy")
+
+    def load_audio(self, content_hash, sr):
+        """Return the decoded samples of a file as a read-only memory map, or None on a miss."""
+        path = self._audio_path(content_hash, sr)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+    def put_audio(self, content_hash, sr, audio):
+        """Store decoded samples as raw PCM that load_audio can memory-map."""
+        path = self._audio_path(content_hash, sr)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, audio)
+        os.replace(tmp_path, path)
+
+    def put_audio_blocks(self, content_hash, sr, length, blocks):
+        """
+        Store samples that arrive in blocks, without holding all of them in memory.
+
+        Returns the stored samples as a memory map, or None if the blocks did not add up
+        to `length` samples, in which case nothing is stored.
+        """
+        path = self._audio_path(content_hash, sr)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        audio = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(length,))
+        written = 0
+        for block in blocks:
+            if written + len(block) > length:
+                break
+            audio[written:written + len(block)] = block
+            written += len(block)
+        else:
+            if written == length:
+                audio.flush()
+                del audio
+                os.replace(tmp_path, path)
+                return self.load_audio(content_hash, sr)
+
+        del audio
+        os.remove(tmp_path)
+        return None
+
+    def _features_path(self, key):
+        return os.path.join(self.directory, "features", key[:2], key)
+
+    def load_features(self, key):
+        """Return stored feature columns as read-only memory maps plus their scalars, or None on a miss."""
+        path = self._features_path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                features = json.load(f)
+            for file_name in os.listdir(path):
+                if file_name.endswith(".npy"):
+                    features[file_name[:-4]] = np.load(os.path.join(path, file_name), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        return features
+
+    def put_features(self, key, features):
+        """Store a dict of feature columns, arrays as one .npy file each and scalars as JSON."""
+        path = self._features_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Build the whole entry in a temporary folder and rename it into place
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        meta = {}
+        for name, value in features.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp_path, f"{name}.npy"), value)
+            else:
+                meta[name] = value
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process stored the same entry first, the contents are identical
+            shutil.rmtree(tmp_path, ignore_errors=True)
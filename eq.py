@@ -4,7 +4,15 @@ This module provides functions for adjusting the EQ of audio tracks.
 
 import math
 import numpy as np
-import yodel.filter
+
+from instrumentation import span
+
+# scipy.signal and soundfile are imported inside the functions that use them,
+# importing scipy.signal alone takes about a second.
+
+# Corner frequencies of the two EQ bands
+LOW_SHELF_FREQ = 500
+HIGH_SHELF_FREQ = 2000
 
 
 def lin2db(linval):
@@ -20,24 +28,248 @@ def db2lin(dbval):
     return math.pow(10, dbval / 20.0)
 
 
+def shelf_sos(sr, freq, gains, kind, q=1):
+    """
+    Computes RBJ shelf filter coefficients for an array of linear gains.
+
+    Args:
+        sr: The sample rate in Hz.
+        freq: The corner frequency in Hz.
+        gains: Linear gains, one filter is designed per value.
+        kind: Either "low" or "high".
+        q: The Q factor of the shelf.
+
+    Returns:
+        An array of shape (len(gains), 6) with one normalised second-order section per gain.
+    """
+    # Gains below -100 dB are clamped, as in lin2db
+    gains = np.maximum(np.asarray(gains, dtype=np.float64), 1e-5)
+
+    a = np.sqrt(gains)  # 10 ** (gain_db / 40)
+    w0 = 2.0 * math.pi * freq / sr
+    cos_w0 = math.cos(w0)
+    two_sqrt_a_alpha = 2.0 * np.sqrt(a) * math.sin(w0) / (2.0 * q)
+
+    sign = 1.0 if kind == "low" else -1.0
+    b0 = a * ((a + 1) - sign * (a - 1) * cos_w0 + two_sqrt_a_alpha)
+    b1 = sign * 2.0 * a * ((a - 1) - sign * (a + 1) * cos_w0)
+    b2 = a * ((a + 1) - sign * (a - 1) * cos_w0 - two_sqrt_a_alpha)
+    a0 = (a + 1) + sign * (a - 1) * cos_w0 + two_sqrt_a_alpha
+    a1 = -sign * 2.0 * ((a - 1) + sign * (a + 1) * cos_w0)
+    a2 = (a + 1) + sign * (a - 1) * cos_w0 - two_sqrt_a_alpha
+
+    return np.stack([b0, b1, b2, a0, a1, a2], axis=-1) / a0[..., np.newaxis]
+
+
 def adjust_highs(audio, sr, gain_db):
     """Adjusts the high frequencies of an audio signal."""
+    from scipy.signal import sosfilt
+
     # High shelf filter starting from 2kHz
-    filter_obj = yodel.filter.Biquad()
-    filter_obj.high_shelf(sr, 2000, 1, gain_db)  # 2000 Hz
-    output = np.zeros_like(audio)
-    filter_obj.process(audio, output)
-    return output
+    sos = shelf_sos(sr, HIGH_SHELF_FREQ, [db2lin(gain_db)], "high")
+    return sosfilt(sos, audio).astype(audio.dtype, copy=False)
 
 
 def adjust_lows(audio, sr, gain_db):
     """Adjusts the low frequencies of an audio signal."""
+    from scipy.signal import sosfilt
+
     # Low shelf filter ending at 500Hz
-    filter_obj = yodel.filter.Biquad()
-    filter_obj.low_shelf(sr, 500, 1, gain_db)  # 500 Hz
-    output = np.zeros_like(audio)
-    filter_obj.process(audio, output)
-    return output
+    sos = shelf_sos(sr, LOW_SHELF_FREQ, [db2lin(gain_db)], "low")
+    return sosfilt(sos, audio).astype(audio.dtype, copy=False)
+
+
+class ShelfEQ:
+    """
+    Low and high shelf filters whose state carries over from one block to the next.
+
+    Feeding consecutive blocks through process() gives the same result as filtering
+    the whole signal at once, so there are no clicks at block boundaries.
+    """
+
+    def __init__(self, sr, low_freq=LOW_SHELF_FREQ, high_freq=HIGH_SHELF_FREQ, q=1):
+        self.sr = sr
+        self.low_freq = low_freq
+        self.high_freq = high_freq
+        self.q = q
+        self.zi = np.zeros((2, 2))
+
+    def reset(self):
+        """Clears the filter state."""
+        self.zi[:] = 0
+
+    def coefficients(self, gains_lows, gains_highs):
+        """Returns an array of shape (n, 2, 6) with the two sections for each gain pair."""
+        lows = shelf_sos(self.sr, self.low_freq, gains_lows, "low", self.q)
+        highs = shelf_sos(self.sr, self.high_freq, gains_highs, "high", self.q)
+        return np.stack([lows, highs], axis=-2)
+
+    def process(self, block, sos):
+        """Filters one block with the given (2, 6) sections and keeps the state for the next block."""
+        from scipy.signal import sosfilt
+
+        output, self.zi = sosfilt(sos, block, zi=self.zi)
+        return output
+
+
+class EQEnvelope:
+    """
+    Low and high gain envelope given as gain pairs at cue times.
+
+    Between two cue times the gains move from one pair to the next, either linearly
+    (as in rapid_eq) or along a sigmoid (as in smooth_eq). After the last cue time the
+    last pair is held.
+    """
+
+    def __init__(self, gains, cue_times, curve="linear"):
+        self.gains = np.asarray(gains, dtype=np.float64)
+        self.cue_times = np.asarray(cue_times, dtype=np.float64)
+        self.curve = curve
+
+    def __call__(self, times):
+        """Returns the (gain_lows, gain_highs) arrays at the given times in seconds."""
+        times = np.asarray(times, dtype=np.float64)
+        if len(self.cue_times) < 2:
+            held = np.broadcast_to(self.gains[-1], times.shape + (2,))
+            return held[..., 0], held[..., 1]
+
+        # Find the segment each time falls in, segments of zero length are never selected
+        segment = np.searchsorted(self.cue_times, times, side="right") - 1
+        after_last = segment >= len(self.cue_times) - 1
+        segment = np.clip(segment, 0, len(self.cue_times) - 2)
+
+        start = self.cue_times[segment]
+        length = self.cue_times[segment + 1] - start
+        with np.errstate(divide="ignore", invalid="ignore"):
+            progress = np.clip((times - start) / length, 0, 1)
+
+        if self.curve == "sigmoid":
+            # Go from -2 to 2 rather than from 0 to 1
+            weight = sigmoid(4 * progress - 2)
+        else:
+            weight = progress
+
+        gains = self.gains[segment] + (self.gains[segment + 1] - self.gains[segment]) * weight[..., np.newaxis]
+
+        # Ensure the gains never drop below a small positive value
+        gains = np.maximum(gains, 0.01)
+        gains[after_last] = self.gains[-1]
+
+        return gains[..., 0], gains[..., 1]
+
+
+def envelope_gains(envelopes, times):
+    """
+    Evaluates one or more EQ envelopes at the given times.
+
+    Stacked envelopes behave like EQ stages applied one after the other, so their
+    gains multiply per band.
+    """
+    if isinstance(envelopes, EQEnvelope):
+        envelopes = [envelopes]
+
+    gains_lows = np.ones(np.shape(times))
+    gains_highs = np.ones(np.shape(times))
+    for envelope in envelopes:
+        lows, highs = envelope(times)
+        gains_lows = gains_lows * lows
+        gains_highs = gains_highs * highs
+
+    return gains_lows, gains_highs
+
+
+class EQRenderer:
+    """
+    Applies EQ envelopes to consecutive pieces of one signal.
+
+    The gains are updated on a fixed grid of `block_size` samples measured from the
+    start of the signal, so rendering a track in any number of pieces gives the same
+    result as rendering it in one go. Only the spans where the gains change are
+    filtered block by block: spans of constant gains get one filter pass and spans of
+    unity gains are copied unfiltered, so the cost follows the length of the transition
+    rather than of the track.
+    """
+
+    def __init__(self, sr, envelopes, block_size=4096):
+        self.sr = sr
+        self.envelopes = envelopes
+        self.block_size = block_size
+        self.eq = ShelfEQ(sr)
+        self.position = 0
+
+    def process(self, audio, start):
+        """
+        Filters the samples of the source signal starting at sample `start`.
+
+        Args:
+            audio: The samples to process.
+            start: Index of the first sample in the source signal.
+
+        Returns:
+            The adjusted samples.
+        """
+        if len(audio) == 0:
+            return audio.copy()
+
+        # A jump in the source restarts the filters
+        if start != self.position:
+            self.eq.reset()
+
+        with span("eq.render", samples=len(audio)) as s:
+            processed_audio = self._process(audio, start)
+            s.add(blocks=-(-len(audio) // self.block_size))
+        return processed_audio
+
+    def _process(self, audio, start):
+        end = start + len(audio)
+        first_block = start // self.block_size
+        splits = np.arange((first_block + 1) * self.block_size, end, self.block_size)
+        bounds = np.concatenate(([start], splits, [end])) - start
+
+        grid = np.arange(first_block, first_block + len(bounds) - 1) * self.block_size
+        gains_lows, gains_highs = envelope_gains(self.envelopes, grid / self.sr)
+
+        # Consecutive blocks with the same gains form one run that is filtered in a single call
+        changes = np.flatnonzero((np.diff(gains_lows) != 0) | (np.diff(gains_highs) != 0)) + 1
+        runs = np.concatenate(([0], changes, [len(grid)]))
+        sos = self.eq.coefficients(gains_lows[runs[:-1]], gains_highs[runs[:-1]])
+
+        processed_audio = np.empty_like(audio)
+        for i in range(len(runs) - 1):
+            lo, hi = bounds[runs[i]], bounds[runs[i + 1]]
+            if gains_lows[runs[i]] == 1 and gains_highs[runs[i]] == 1:
+                # Unity shelves pass the signal through, the first block still lets
+                # the state left by the filtered blocks before it ring out
+                if self.eq.zi.any():
+                    settle = bounds[runs[i] + 1]
+                    processed_audio[lo:settle] = self.eq.process(audio[lo:settle], sos[i])
+                    lo = settle
+                processed_audio[lo:hi] = audio[lo:hi]
+                self.eq.reset()
+            else:
+                processed_audio[lo:hi] = self.eq.process(audio[lo:hi], sos[i])
+
+        self.position = end
+        return processed_audio
+
+
+def render_eq(audio, sr, envelopes, block_size=4096):
+    """
+    Applies EQ envelopes to an audio signal.
+
+    The gains are evaluated once per block and the filter state is carried across
+    blocks, so the result is free of discontinuities at block boundaries.
+
+    Args:
+        audio: The audio signal as a numpy array.
+        sr: The sample rate of the audio signal.
+        envelopes: An EQEnvelope or a list of them.
+        block_size: Number of samples over which the gains are held constant.
+
+    Returns:
+        The adjusted audio signal.
+    """
+    return EQRenderer(sr, envelopes, block_size).process(audio, 0)
 
 
 def adjust_audio(audio, sr, gains):
@@ -68,43 +300,10 @@ def adjust_audio(audio, sr, gains):
     return audio
 
 
-def rapid_eq(audio, sr, gains, cue_times, chunk_size=44100):
+def rapid_eq(audio, sr, gains, cue_times, chunk_size=4096):
     """Applies rapid EQ changes to an audio signal."""
-    # Calculate the cue samples
-    cue_samples = [int(t * sr) for t in cue_times]
-
-    # Create a new array to hold the processed audio
-    processed_audio = np.zeros_like(audio)
-
-    # Apply the EQ changes in chunks
-    for i in range(len(cue_samples) - 1):
-        # Calculate the slope of the EQ change for this period
-        slope_lows = (gains[i + 1][0] - gains[i][0]) / (cue_samples[i + 1] - cue_samples[i])
-        slope_highs = (gains[i + 1][1] - gains[i][1]) / (cue_samples[i + 1] - cue_samples[i])
-
-        for j in range(cue_samples[i], cue_samples[i + 1], chunk_size):
-            # Calculate the current time in seconds
-            current_time = j / sr
-
-            # Calculate the current gains
-            current_gain_lows = gains[i][0] + slope_lows * (current_time - cue_times[i])
-            current_gain_highs = gains[i][1] + slope_highs * (current_time - cue_times[i])
-
-            # Ensure the gains never drop below a small positive value
-            current_gain_lows = max(current_gain_lows, 0.01)
-            current_gain_highs = max(current_gain_highs, 0.01)
-
-            # Calculate the chunk end sample
-            end_j = min(j + chunk_size, len(audio))
-
-            # Apply the EQ changes
-            processed_audio[j:end_j] = adjust_audio(audio[j:end_j], sr, [current_gain_lows, current_gain_highs])
-
-    # After the last cue time, keep the EQ changes at the last gains
-    if cue_samples[-1] < len(audio):
-        processed_audio[cue_samples[-1]:] = adjust_audio(audio[cue_samples[-1]:], sr, gains[-1])
-
-    return processed_audio
+    # The gains move linearly between cue times and are updated every chunk
+    return render_eq(audio, sr, EQEnvelope(gains, cue_times, "linear"), block_size=chunk_size)
 
 
 def sigmoid(x):
@@ -112,43 +311,10 @@ def sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
-def smooth_eq(audio, sr, gains, cue_times, chunk_size=44100):
+def smooth_eq(audio, sr, gains, cue_times, chunk_size=4096):
     """Applies smooth EQ changes to an audio signal."""
-    # Calculate the cue samples
-    cue_samples = [int(t * sr) for t in cue_times]
-
-    # Create a new array to hold the processed audio
-    processed_audio = np.zeros_like(audio)
-
-    # Apply the EQ changes in chunks
-    for i in range(len(cue_samples) - 1):
-        # Calculate the length of the transition in samples
-        transition_length = cue_samples[i + 1] - cue_samples[i]
-
-        for j in range(cue_samples[i], cue_samples[i + 1], chunk_size):
-            # Calculate the proportion of the transition that has elapsed,
-            # adjusted to go from -2 to 2 rather than from 0 to 1
-            transition_progress = 4 * (j - cue_samples[i]) / transition_length - 2
-
-            # Use the sigmoid function to calculate the current gains
-            current_gain_lows = gains[i][0] + (gains[i + 1][0] - gains[i][0]) * sigmoid(transition_progress)
-            current_gain_highs = gains[i][1] + (gains[i + 1][1] - gains[i][1]) * sigmoid(transition_progress)
-
-            # Ensure the gains never drop below a small positive value
-            current_gain_lows = max(current_gain_lows, 0.01)
-            current_gain_highs = max(current_gain_highs, 0.01)
-
-            # Calculate the chunk end sample
-            end_j = min(j + chunk_size, len(audio))
-
-            # Apply the EQ changes
-            processed_audio[j:end_j] = adjust_audio(audio[j:end_j], sr, [current_gain_lows, current_gain_highs])
-
-    # After the last cue time, keep the EQ changes at the last gains
-    if cue_samples[-1] < len(audio):
-        processed_audio[cue_samples[-1]:] = adjust_audio(audio[cue_samples[-1]:], sr, gains[-1])
-
-    return processed_audio
+    # The gains follow a sigmoid between cue times and are updated every chunk
+    return render_eq(audio, sr, EQEnvelope(gains, cue_times, "sigmoid"), block_size=chunk_size)
 
 
 def beats_to_seconds(bpm, beats):
@@ -160,8 +326,8 @@ def beats_to_seconds(bpm, beats):
 
 def normalize_audio_gain(audio, target=-10):
     """Normalizes the gain of an audio signal."""
-    # Calculate the current gain of the audio
-    rgain = 10 * np.log10(np.mean(audio**2))
+    # Calculate the current gain of the audio, the dot product avoids a squared copy
+    rgain = 10 * np.log10(np.dot(audio, audio) / len(audio))
 
     # Calculate the normalization factor
     factor = 10**((-(target - rgain)/10.0) / 2.0) # Divide by 2 because we want sqrt (amplitude^2 is energy)
@@ -172,37 +338,70 @@ def normalize_audio_gain(audio, target=-10):
     return audio_normalized
 
 
-def create_eq_adjusted_tracks(track1, track2, t1_bass, t2_bass, sr):
-    """Create EQ adjusted versions of two tracks."""
+def normalize_file_gain(input_file, output_file, target=-10, block_size=65536, subtype=None):
+    """Normalizes the gain of an audio file block by block, like normalize_audio_gain."""
+    with span("eq.normalize_file_gain"):
+        _normalize_file_gain(input_file, output_file, target, block_size, subtype)
+
+
+def _normalize_file_gain(input_file, output_file, target, block_size, subtype):
+    import soundfile as sf
+
+    # First pass: accumulate the energy without loading the whole file
+    energy = 0.0
+    frames = 0
+    for block in sf.blocks(input_file, blocksize=block_size, dtype="float32"):
+        energy += float(np.dot(block.ravel(), block.ravel()))
+        frames += block.size
+    rgain = 10 * np.log10(energy / frames)
+    factor = 10**((-(target - rgain)/10.0) / 2.0)
+
+    # Second pass: scale and write
+    info = sf.info(input_file)
+    with sf.SoundFile(output_file, "w", samplerate=info.samplerate, channels=info.channels,
+                      subtype=subtype) as out:
+        for block in sf.blocks(input_file, blocksize=block_size, dtype="float32"):
+            block *= factor
+            out.write(block)
+
+
+def bass_swap_envelopes(t1_bass, t2_bass):
+    """Returns the EQ envelopes that swap the bass of two tracks."""
+    # track1 (the master) loses its bass, track2 (the slave) gets it
+    envelope1 = EQEnvelope([[1, 1], [0.2, 1]], [0, t1_bass], "linear")
+    envelope2 = EQEnvelope([[0.2, 1], [1, 1]], [0, t2_bass], "linear")
+    return envelope1, envelope2
+
+
+def treble_swap_envelopes(t1_treble, t2_treble, duration):
+    """Returns the EQ envelopes that swap the treble of two tracks over `duration` seconds."""
     # Define the gains and cue times for track1 (the master)
-    gains1_bass = [[1, 1], [0.2, 1]]
-    cue_times1_bass = [0, t1_bass]
+    envelope1 = EQEnvelope([[1, 1], [1, 1], [1, 0.7], [1, 0.1]],
+                           [0, t1_treble, t1_treble + 0.8*duration, t1_treble + duration], "sigmoid")
 
     # Define the gains and cue times for track2 (the slave)
-    gains2_bass = [[0.2, 1], [1, 1]]
-    cue_times2_bass = [0, t2_bass]
+    envelope2 = EQEnvelope([[1, 0.1], [1, 0.1], [1, 0.7], [1, 1]],
+                           [0, t2_treble, t2_treble + 0.5*duration, t2_treble + duration], "sigmoid")
+    return envelope1, envelope2
+
+
+def create_eq_adjusted_tracks(track1, track2, t1_bass, t2_bass, sr):
+    """Create EQ adjusted versions of two tracks."""
+    envelope1, envelope2 = bass_swap_envelopes(t1_bass, t2_bass)
 
     # Apply the EQ changes to the tracks
-    track1_eq_bass = rapid_eq(track1, sr, gains1_bass, cue_times1_bass)
-    track2_eq_bass = rapid_eq(track2, sr, gains2_bass, cue_times2_bass)
+    track1_eq_bass = render_eq(track1, sr, envelope1)
+    track2_eq_bass = render_eq(track2, sr, envelope2)
 
     return track1_eq_bass, track2_eq_bass
 
 
 def create_eq_adjusted_tracks_treble(track1, track2, t1_treble, t2_treble, duration, sr):
     """Create EQ adjusted versions of two tracks with treble adjustments."""
-    # Define the gains and cue times for track1 (the master)
-    gains1_treble = [[1, 1], [1, 1], [1, 0.7], [1, 0.1]]
-    cue_times1_treble = [0, t1_treble,
-                         t1_treble+0.8*duration,
-                         t1_treble+duration]
-
-    # Define the gains and cue times for track2 (the slave)
-    gains2_treble = [[1, 0.1], [1, 0.1], [1, 0.7], [1, 1]]
-    cue_times2_treble = [0, t2_treble, t2_treble + 0.5*duration, t2_treble + duration]
+    envelope1, envelope2 = treble_swap_envelopes(t1_treble, t2_treble, duration)
 
     # Apply the EQ changes to the tracks
-    track1_eq_treble = smooth_eq(track1, sr, gains1_treble, cue_times1_treble)
-    track2_eq_treble = smooth_eq(track2, sr, gains2_treble, cue_times2_treble)
+    track1_eq_treble = render_eq(track1, sr, envelope1)
+    track2_eq_treble = render_eq(track2, sr, envelope2)
 
     return track1_eq_treble, track2_eq_treble
@@ -0,0 +1,170 @@
+"""
+Frame-level features of a track, kept column by column so they can be memory-mapped.
+
+Everything the cue-point rules look at is computed in one pass over the audio and
+stored per track in the AnalysisCache. New cue heuristics can then be swept over a
+whole library from the stored features alone:
+
+    features = load_features(cache, content_hash)
+    result = cue_points_from_features(features, percentile=95)
+"""
+
+import numpy as np
+
+from cache import analysis_key
+from eq import HIGH_SHELF_FREQ, LOW_SHELF_FREQ
+from preprocessing import (
+    calculate_rms_transitions_indices,
+    filter_consecutive_indices,
+    get_cue_points_from_filtered_indices
+)
+
+# Bump when compute_features() changes what a column holds
+FEATURES_VERSION = 2
+
+
+def _frame_samples(audio, first, last, window_size, hop_length):
+    """Samples behind frames [first, last), zero-padded past the ends like centred librosa frames."""
+    lo = first * hop_length - window_size // 2
+    hi = (last - 1) * hop_length + window_size - window_size // 2
+    samples = np.zeros(hi - lo, dtype=np.float32)
+    samples[max(0, -lo):min(hi, len(audio)) - lo] = audio[max(0, lo):min(hi, len(audio))]
+    return samples
+
+
+def _spectral_flux(power, mel_basis, previous):
+    """
+    Onset strength of STFT power frames: the mean rise of the log-mel spectrum per frame.
+
+    `previous` is the last log-mel frame before `power`, None at the start of the signal.
+    Returns the onset strengths and the log-mel frame to pass with the next chunk.
+    """
+    import librosa
+
+    mel_db = librosa.power_to_db(mel_basis @ power, top_db=None)
+    if previous is None:
+        previous = mel_db[:, :1]
+    flux = np.maximum(0, np.diff(mel_db, axis=1, prepend=previous))
+    return flux.mean(axis=0), mel_db[:, -1:]
+
+
+def onset_envelope(audio, sr, window_size=1024, hop_length=512, chunk_frames=None):
+    """
+    Compute only the "onset" column of compute_features(), frame for frame the same values.
+
+    Args:
+        audio: The mono signal.
+        sr: The sample rate.
+        window_size: Frame length of the STFT.
+        hop_length: Hop between frames.
+        chunk_frames: Frames processed at a time, defaults to all of them.
+
+    Returns:
+        The float32 onset strength of every frame.
+    """
+    import librosa
+
+    n_frames = 1 + len(audio) // hop_length
+    onset = np.empty(n_frames, dtype=np.float32)
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=window_size)
+
+    previous = None
+    for first in range(0, n_frames, chunk_frames or n_frames):
+        last = min(first + (chunk_frames or n_frames), n_frames)
+        samples = _frame_samples(audio, first, last, window_size, hop_length)
+        power = np.abs(librosa.stft(samples, n_fft=window_size, hop_length=hop_length, center=False)) ** 2
+        onset[first:last], previous = _spectral_flux(power, mel_basis, previous)
+    return onset
+
+
+def compute_features(audio, sr, beats, downbeats, window_size=1024, hop_length=512, chunk_frames=None):
+    """
+    Compute the frame-level features of a track.
+
+    Every frame only depends on its own samples (and the onset on the previous frame),
+    so the audio can be processed in chunks of `chunk_frames` frames with the same
+    result as in one go. With a memory-mapped `audio`, memory use then depends on the
+    chunk size rather than the length of the track.
+
+    Args:
+        audio: The mono signal.
+        sr: The sample rate.
+        beats: Beat times in seconds.
+        downbeats: Downbeats as returned by detect_downbeats().
+        window_size: Frame length of the RMS and STFT.
+        hop_length: Hop between frames, shared by every frame-level column.
+        chunk_frames: Frames processed at a time, defaults to all of them.
+
+    Returns:
+        A dict with the float32 columns "rms", "onset", "low_energy" (below
+        LOW_SHELF_FREQ) and "high_energy" (above HIGH_SHELF_FREQ), the "beats" and
+        "downbeats" grids, and the scalars "sr", "window_size" and "hop_length".
+    """
+    import librosa
+
+    # Same frames as librosa.feature.rms(y=audio), so cue points do not change
+    n_frames = 1 + len(audio) // hop_length
+    columns = {name: np.empty(n_frames, dtype=np.float32) for name in ("rms", "onset", "low_energy", "high_energy")}
+    frequencies = librosa.fft_frequencies(sr=sr, n_fft=window_size)
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=window_size)
+
+    previous = None
+    for first in range(0, n_frames, chunk_frames or n_frames):
+        last = min(first + (chunk_frames or n_frames), n_frames)
+        samples = _frame_samples(audio, first, last, window_size, hop_length)
+
+        columns["rms"][first:last] = librosa.feature.rms(y=samples, frame_length=window_size, hop_length=hop_length,
+                                                         center=False)[0]
+
+        # A single STFT feeds both band energies and the onset envelope
+        power = np.abs(librosa.stft(samples, n_fft=window_size, hop_length=hop_length, center=False)) ** 2
+        columns["low_energy"][first:last] = power[frequencies < LOW_SHELF_FREQ].sum(axis=0)
+        columns["high_energy"][first:last] = power[frequencies > HIGH_SHELF_FREQ].sum(axis=0)
+
+        columns["onset"][first:last], previous = _spectral_flux(power, mel_basis, previous)
+
+    return {
+        **columns,
+        "beats": np.asarray(beats, dtype=np.float64),
+        "downbeats": np.asarray(downbeats, dtype=np.float64),
+        "sr": sr,
+        "window_size": window_size,
+        "hop_length": hop_length,
+    }
+
+
+def features_key(content_hash, fps=100, window_size=1024, hop_length=512, **window_params):
+    """
+    Cache key of the features of a file.
+
+    The grids depend on `fps` through the downbeats, and on the window and overlap of a
+    windowed analysis, which are passed as `window_params`.
+    """
+    return analysis_key(content_hash, features=FEATURES_VERSION, fps=fps, window_size=window_size,
+                        hop_length=hop_length, **window_params)
+
+
+def load_features(cache, content_hash, fps=100, window_size=1024, hop_length=512, **window_params):
+    """Return the stored features of a file as memory maps, or None if they were never computed."""
+    return cache.load_features(features_key(content_hash, fps, window_size, hop_length, **window_params))
+
+
+def cue_points_from_features(features, percentile=97.5, consecutive_index_distance=3):
+    """
+    Run the RMS cue-point rules on stored features, without the audio.
+
+    Returns:
+        A dict with "filtered_indices_rms", "cue_points_rms" and "cue_point_counts",
+        the same values preprocess() stores on a Track.
+    """
+    beats = np.asarray(features["beats"])
+    top_rms_indices, rms_transitions = calculate_rms_transitions_indices(
+        None, features["sr"], beats, hop_length=features["hop_length"], percentile=percentile,
+        rms=features["rms"])
+    filtered_indices = filter_consecutive_indices(top_rms_indices, rms_transitions, consecutive_index_distance)
+
+    return {
+        "filtered_indices_rms": filtered_indices,
+        "cue_points_rms": get_cue_points_from_filtered_indices(filtered_indices, beats),
+        "cue_point_counts": np.bincount(np.asarray(filtered_indices, dtype=int) % 4, minlength=4).tolist(),
+    }
@@ -1,7 +1,15 @@
 import os
-import pickle
-from pydub import AudioSegment
-import librosa
+
+import numpy as np
+
+from cache import AnalysisCache, file_hash
+from ingest import ingest_tracks
+
+# Files the ingest path can decode directly, no intermediate WAV needed
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aiff")
+
+# Sample rate used everywhere in the pipeline
+SAMPLE_RATE = 44100
 
 
 def convert_to_wav(mp3_file, wav_file):
@@ -10,58 +18,94 @@ def convert_to_wav(mp3_file, wav_file):
     :param mp3_file: Path to the input MP3 file.
     :param wav_file: Path to the output WAV file.
     """
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_mp3(mp3_file)
     audio.export(wav_file, format='wav')
 
 
-def load_track(wav_file):
-    audio, sr = librosa.load(wav_file)
+def load_track(wav_file, sr=SAMPLE_RATE):
+    import librosa
+
+    audio, sr = librosa.load(wav_file, sr=sr, mono=True, dtype=np.float32)
     return audio, sr
 
 
-def main():
-    # Define the paths to the pickle files
-    tracks_pickle_file = "loaded_tracks.pkl"
-    wav_files_pickle_file = "wav_files.pkl"
+def decode_file(name, path, cache_dir=None, sr=SAMPLE_RATE, wav_dir=None):
+    """
+    Decode a compressed or uncompressed file straight to mono float32 at `sr`.
+
+    :param name: Name of the track, the WAV copy is named after it.
+    :param path: Path to the input file.
+    :param cache_dir: If given, the samples are stored in this AnalysisCache, where
+        Track memory-maps them, and are not returned.
+    :param sr: Sample rate to decode to.
+    :param wav_dir: If given, a WAV copy is also written to this directory.
+    :return: A dict with the path, content hash and duration, plus the samples under
+        "audio" when no cache_dir is given.
+    """
+    content_hash = file_hash(path)
+    record = {"path": path, "content_hash": content_hash}
+
+    cache = AnalysisCache(cache_dir) if cache_dir is not None else None
+    audio = cache.load_audio(content_hash, sr) if cache is not None else None
+    if audio is None:
+        audio, _ = load_track(path, sr)
+        if cache is not None:
+            cache.put_audio(content_hash, sr, audio)
 
-    # If the pickle files already exist, load them and return
-    if os.path.exists(tracks_pickle_file) and os.path.exists(wav_files_pickle_file):
-        with open(tracks_pickle_file, "rb") as f:
-            loaded_tracks = pickle.load(f)
-        with open(wav_files_pickle_file, "rb") as f:
-            wav_files = pickle.load(f)
-        return loaded_tracks, wav_files
+    if wav_dir is not None:
+        import soundfile as sf
 
-    mp3_dir = "path_to_your_mp3_files"  # replace with the path to your MP3 files
-    wav_dir = "path_to_store_converted_files"  # replace with the path where you want to store WAV files
+        wav_file = os.path.join(wav_dir, f"{name}.wav")
+        sf.write(wav_file, audio, sr)
+        record["wav_file"] = wav_file
 
-    os.makedirs(wav_dir, exist_ok=True)
+    record["duration"] = len(audio) / sr
+    if cache is None:
+        record["audio"] = np.asarray(audio)
+    return record
 
-    file_names = os.listdir(mp3_dir)  # Get all the files in the directory
-    file_names = [file_name for file_name in file_names if file_name.endswith(".mp3")]  # Filter for .mp3 files
 
-    wav_files = []
+def ingest_folder(input_dir, workers=None, sr=SAMPLE_RATE, cache_dir=".analysis-cache", wav_dir=None):
+    """
+    Decode every audio file in a folder across a pool of worker processes.
+
+    :param input_dir: Folder with MP3, WAV or other supported files.
+    :param workers: Number of worker processes, defaults to the number of CPUs.
+    :param sr: Sample rate to decode to.
+    :param cache_dir: AnalysisCache the decoded samples go to, None returns them instead.
+    :param wav_dir: Only if given, WAV copies are written there.
+    :return: A tuple (records, failures) keyed by file name without extension.
+    """
+    file_names = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(AUDIO_EXTENSIONS))
+    if wav_dir is not None:
+        os.makedirs(wav_dir, exist_ok=True)
 
-    for file_name in file_names:
-        mp3_file = os.path.join(mp3_dir, file_name)
-        wav_file = os.path.join(wav_dir, f"{file_name[:-4]}.wav")  # replace .mp3 with .wav
-        convert_to_wav(mp3_file, wav_file)
-        wav_files.append(wav_file)
+    paths = {os.path.splitext(file_name)[0]: os.path.join(input_dir, file_name) for file_name in file_names}
+    return ingest_tracks(paths, workers=workers, cache_dir=cache_dir, task=decode_file, verb="Decoded",
+                         sr=sr, wav_dir=wav_dir)
+
+
+def main():
+    input_dir = "path_to_your_mp3_files"  # replace with the path to your MP3 files
+    wav_dir = None  # set to a folder to also keep WAV copies of the decoded files
 
-    loaded_tracks = [load_track(wav_file) for wav_file in wav_files]
+    from library import Library
 
-    # Before returning, save the results to pickle files for next time
-    with open(tracks_pickle_file, "wb") as f:
-        pickle.dump(loaded_tracks, f)
-    with open(wav_files_pickle_file, "wb") as f:
-        pickle.dump(wav_files, f)
+    # Decode every file once into the cache, tracks then memory-map the samples
+    cache = AnalysisCache()
+    records, _ = ingest_folder(input_dir, cache_dir=cache.directory, wav_dir=wav_dir)
 
-    return loaded_tracks, wav_files
+    # The workers already hashed every file, the library does not read them again
+    library = Library(input_dir)
+    library.scan(hashes={record["path"]: record["content_hash"] for record in records.values()})
+    return library.tracks(cache)
 
 
 if __name__ == "__main__":
-    loaded_tracks, wav_files = main()
-    for i, (track, wav_file) in enumerate(zip(loaded_tracks, wav_files)):
+    tracks = main()
+    for i, (name, track) in enumerate(tracks.items()):
         print(f"Track {i}:")
-        print(track)
-        print(wav_file)
+        print(name)
+        print(track.wav_file)
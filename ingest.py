@@ -0,0 +1,90 @@
+"""Parallel analysis of a whole library of tracks."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import instrumentation
+from cache import AnalysisCache
+from preprocessing import get_analyser
+from track import Track, preprocess
+
+
+def analyse_file(name, wav_file, cache_dir=None, **params):
+    """
+    Decode and preprocess a single file.
+
+    Args:
+        name: The key the track is stored under.
+        wav_file: Path to the audio file.
+        cache_dir: Optional AnalysisCache directory shared by all workers.
+        **params: Analysis parameters forwarded to preprocess().
+
+    Returns:
+        A picklable analysis record: the Track.analysis() dict plus the track's
+        name, file, sample rate, content hash and duration. The decoded audio is not included.
+        While instrumentation is on, "spans" holds what was recorded since the last
+        record, for ingest_tracks() to merge.
+    """
+    # With the cache the worker decodes into the shared PCM store, which the parent then memory-maps
+    cache = AnalysisCache(cache_dir) if cache_dir is not None else None
+    track = Track(name, wav_file, cache=cache)
+    preprocess(track, cache=cache, **params)
+
+    record = track.analysis()
+    record["name"] = name
+    record["wav_file"] = wav_file
+    record["sr"] = track.sr
+    record["content_hash"] = track.content_hash
+    record["duration"] = track.duration
+    record["spans"] = instrumentation.collect()
+    return record
+
+
+def _init_worker(fps, instrument):
+    # Spawned workers do not inherit the parent's instrumentation mode
+    instrumentation.configure(instrument)
+    get_analyser(fps)
+
+
+def ingest_tracks(wav_files, workers=None, cache_dir=None, task=analyse_file, verb="Analysed", **params):
+    """
+    Analyse many files in a process pool.
+
+    Args:
+        wav_files: A dict mapping track names to file paths.
+        workers: Number of worker processes, defaults to the number of CPUs.
+        cache_dir: Optional AnalysisCache directory.
+        task: Run on every file as task(name, wav_file, cache_dir, **params), must
+            return a picklable record. Defaults to analyse_file().
+        verb: What the progress lines say was done to a file.
+        **params: Parameters forwarded to the task, for analyse_file() those of preprocess().
+
+    Returns:
+        A tuple (records, failures). records maps names to analysis records,
+        failures maps names of tracks that could not be analysed to the error.
+    """
+    workers = workers or os.cpu_count()
+    records = {}
+    failures = {}
+
+    # Each worker creates its Analyser up front, every track it analyses then reuses the loaded models
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(params.get("fps", 100), instrumentation.mode())) as pool:
+        futures = {
+            pool.submit(task, name, wav_file, cache_dir, **params): name
+            for name, wav_file in wav_files.items()
+        }
+
+        # Report tracks as they finish, a bad file must not abort the batch
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                records[name] = future.result()
+                instrumentation.merge(records[name].pop("spans", None))
+            except Exception as e:
+                failures[name] = e
+                print(f"[{done}/{len(futures)}] Failed : {name}: {e!r}")
+            else:
+                print(f"[{done}/{len(futures)}] {verb} : {name}")
+
+    return records, failures
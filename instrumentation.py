@@ -0,0 +1,179 @@
+"""
+Timing spans for the analysis and mixing pipeline.
+
+Instrumentation is off by default. It can be switched with configure() or the
+AIDJ_INSTRUMENT environment variable:
+
+    off      spans cost a single check and record nothing
+    summary  spans are aggregated per name and report() prints a table
+    trace    every span is kept and report() writes a Chrome trace event file that
+             chrome://tracing, Perfetto and speedscope can open
+
+Usage:
+
+    with span("eq.render", samples=len(audio)) as s:
+        ...
+        s.add(blocks=n_blocks)
+"""
+
+import json
+import os
+import threading
+import time
+
+OFF = "off"
+SUMMARY = "summary"
+TRACE = "trace"
+
+_mode = OFF
+_trace_file = "trace.json"
+_events = []
+_totals = {}
+_lock = threading.Lock()
+
+
+class _NullSpan:
+    """Span returned while instrumentation is off, every method is a no-op."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """A timed region with counters such as samples processed, beats or cue points."""
+
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.start, time.perf_counter() - self.start, self.counters)
+        return False
+
+    def add(self, **counters):
+        """Attach more counters, numbers are summed in the summary."""
+        self.counters.update(counters)
+
+
+def configure(mode=OFF, trace_file=None):
+    """Switch instrumentation mode and clear everything recorded so far."""
+    global _mode, _trace_file
+    if mode not in (OFF, SUMMARY, TRACE):
+        raise ValueError(f"Unknown instrumentation mode: {mode!r}")
+    _mode = mode
+    if trace_file is not None:
+        _trace_file = trace_file
+    _events.clear()
+    _totals.clear()
+
+
+def mode():
+    """Return the current instrumentation mode."""
+    return _mode
+
+
+def span(name, **counters):
+    """Return a context manager that times the enclosed block under `name`."""
+    if _mode == OFF:
+        return _NULL_SPAN
+    return Span(name, counters)
+
+
+def _record(name, start, duration, counters):
+    with _lock:
+        total = _totals.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0, "counters": {}})
+        total["count"] += 1
+        total["seconds"] += duration
+        total["max"] = max(total["max"], duration)
+        for key, value in counters.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total["counters"][key] = total["counters"].get(key, 0) + value
+
+        if _mode == TRACE:
+            _events.append({
+                "name": name,
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": duration * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {key: value if isinstance(value, (int, float, str)) else repr(value)
+                         for key, value in counters.items()},
+            })
+
+
+def collect():
+    """
+    Take everything recorded in this process so far, e.g. to send it from a pool worker.
+
+    Returns:
+        A picklable dict for merge(), or None while instrumentation is off. The
+        recorded spans are cleared, so each span is only collected once.
+    """
+    if _mode == OFF:
+        return None
+    with _lock:
+        collected = {"totals": dict(_totals), "events": list(_events)}
+        _totals.clear()
+        _events.clear()
+    return collected
+
+
+def merge(collected):
+    """Add spans returned by collect() in another process to this one's."""
+    if not collected:
+        return
+    with _lock:
+        for name, other in collected["totals"].items():
+            total = _totals.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0, "counters": {}})
+            total["count"] += other["count"]
+            total["seconds"] += other["seconds"]
+            total["max"] = max(total["max"], other["max"])
+            for key, value in other["counters"].items():
+                total["counters"][key] = total["counters"].get(key, 0) + value
+        if _mode == TRACE:
+            # perf_counter() is system-wide on Linux, so worker events line up with ours
+            _events.extend(collected["events"])
+
+
+def summary():
+    """Return the aggregated spans as a human readable table."""
+    lines = [f"{'span':<36} {'count':>6} {'total s':>9} {'mean ms':>9} {'max ms':>9}  counters"]
+    for name, total in sorted(_totals.items(), key=lambda item: -item[1]["seconds"]):
+        counters = ", ".join(f"{key}={value:g}" for key, value in total["counters"].items())
+        lines.append(f"{name:<36} {total['count']:>6} {total['seconds']:>9.3f} "
+                     f"{1000 * total['seconds'] / total['count']:>9.2f} {1000 * total['max']:>9.2f}  {counters}")
+    return "\n".join(lines)
+
+
+def write_trace(path=None):
+    """Write the recorded spans as a Chrome trace event file and return its path."""
+    path = path or _trace_file
+    with open(path, "w") as f:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms"}, f)
+    return path
+
+
+def report():
+    """Print the summary or write the trace file, depending on the mode."""
+    if _mode == SUMMARY:
+        print(summary())
+    elif _mode == TRACE:
+        print(f"Trace written to {write_trace()}")
+
+
+configure(os.environ.get("AIDJ_INSTRUMENT", OFF), os.environ.get("AIDJ_TRACE_FILE"))
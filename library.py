@@ -0,0 +1,124 @@
+"""Incremental index of a folder of tracks with stable track IDs."""
+
+import json
+import os
+
+from cache import file_hash
+from file_load_conversion import AUDIO_EXTENSIONS
+from track import Track
+
+
+class Library:
+    """
+    Remembers the path, size, modification time and content hash of every file in a folder.
+
+    A rescan only hashes files whose size or modification time changed, so unchanged
+    files cost a stat() each. Track IDs are kept across runs: a file keeps its ID when
+    its contents change, and a file that was moved or renamed inside the folder is
+    recognised by its hash and keeps its ID too.
+
+    Args:
+        folder: The folder with the audio files.
+        index_file: Where the index is kept, defaults to ".library.json" in the folder.
+    """
+
+    def __init__(self, folder, index_file=None):
+        self.folder = folder
+        self.index_file = index_file or os.path.join(folder, ".library.json")
+        self.entries = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.entries = json.load(f)["tracks"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _new_id(self, path):
+        # The first word of the file name, numbered from 2 when that ID is already taken
+        stem = os.path.splitext(os.path.basename(path))[0]
+        base = (stem.split() or [stem])[0]
+        track_id = base
+        number = 2
+        while track_id in self.entries:
+            track_id = f"{base}{number}"
+            number += 1
+        return track_id
+
+    def scan(self, hashes=None):
+        """
+        Bring the index up to date with the folder and save it.
+
+        Args:
+            hashes: Content hashes already computed for some of the files, a dict
+                mapping paths to hashes. Those files are not read again.
+
+        Returns:
+            A tuple (added, changed, removed) of track ID lists. Only added and
+            changed tracks need to be analysed again.
+        """
+        paths = sorted(os.path.join(self.folder, f) for f in os.listdir(self.folder)
+                       if f.lower().endswith(AUDIO_EXTENSIONS))
+        by_path = {entry["path"]: track_id for track_id, entry in self.entries.items()}
+        hashes = hashes or {}
+
+        seen = set()
+        new_files = []
+        changed = []
+        for path in paths:
+            stat = os.stat(path)
+            track_id = by_path.get(path)
+            if track_id is None:
+                new_files.append((path, stat))
+                continue
+
+            seen.add(track_id)
+            entry = self.entries[track_id]
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                continue
+
+            # Touched files are hashed, only different contents count as a change
+            content_hash = hashes.get(path) or file_hash(path)
+            if content_hash != entry["content_hash"]:
+                changed.append(track_id)
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, content_hash=content_hash)
+
+        # A new file with the contents of a file that is gone is the same track, moved or renamed
+        # Duplicates share a hash, so each hash maps to all of its missing IDs and a new file takes one
+        missing = {}
+        for track_id in self.entries:
+            if track_id not in seen:
+                missing.setdefault(self.entries[track_id]["content_hash"], []).append(track_id)
+        added = []
+        for path, stat in new_files:
+            content_hash = hashes.get(path) or file_hash(path)
+            track_id = missing[content_hash].pop(0) if missing.get(content_hash) else None
+            if track_id is None:
+                track_id = self._new_id(path)
+                added.append(track_id)
+            self.entries[track_id] = {
+                "path": path,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "content_hash": content_hash,
+            }
+
+        removed = sorted(track_id for track_ids in missing.values() for track_id in track_ids)
+        for track_id in removed:
+            del self.entries[track_id]
+
+        self.save()
+        return added, changed, removed
+
+    def save(self):
+        """Write the index, replacing the old one atomically."""
+        tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"tracks": self.entries}, f, indent=1)
+        os.replace(tmp_path, self.index_file)
+
+    def tracks(self, cache=None):
+        """Return a dict mapping track IDs to Tracks, with the content hashes already known."""
+        return {
+            track_id: Track(track_id, entry["path"], cache=cache, content_hash=entry["content_hash"])
+            for track_id, entry in self.entries.items()
+        }
@@ -0,0 +1,245 @@
+"""
+Real-time block playback of decks for live transitions.
+
+The engine pulls fixed-size blocks from the same Decks the offline renderer uses, so
+EQ envelopes and fades apply per block exactly as in render_mix. Tracks that need
+tempo matching are stretched on a background thread ahead of the playhead:
+
+    slave_audio = LookaheadBuffer(slave.audio, slave.sr, tempo_ratio, start=slave_cue * tempo_ratio)
+    slave_audio.start()
+    decks = transition_decks(master.audio, slave_audio, acue, slave_cue, sr, eq1=[...], eq2=[...])
+    stats = LiveEngine(decks, sr, FileSink("live.wav", sr)).run()
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from tempo import stretch_cache, stretch_region
+
+
+class Underrun(Exception):
+    """Raised when a lookahead buffer does not hold the requested samples yet."""
+
+
+class LookaheadBuffer:
+    """
+    A track stretched in chunks on a background thread, ahead of the playhead.
+
+    It behaves like a read-only array on the stretched timeline, so it can be used as
+    the audio of a Deck. Samples before `start` read as silence, samples that are not
+    stretched yet raise Underrun.
+    """
+
+    def __init__(self, audio, sr, tempo_ratio, start=0.0, chunk=2.0, lookahead=8.0, key=None,
+                 cache=stretch_cache):
+        self.audio = audio
+        self.sr = sr
+        self.tempo_ratio = tempo_ratio
+        self.key = key
+        self.cache = cache
+        self.chunk_samples = int(chunk * sr)
+        self.lookahead_samples = int(lookahead * sr)
+
+        self.source_start = int(start * sr)
+        self.first = int(round(self.source_start / tempo_ratio))
+        self.length = int(round(len(audio) / tempo_ratio))
+
+        self._chunks = deque()
+        self._ready_until = self.first
+        self._playhead = self.first
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+
+    def start(self):
+        """Start stretching in the background."""
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the background thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def wait_ready(self, seconds, timeout=None):
+        """Block until `seconds` of audio past the start are stretched."""
+        target = min(self.first + int(seconds * self.sr), self.length)
+        with self._condition:
+            return self._condition.wait_for(lambda: self._ready_until >= target or self._stopped, timeout)
+
+    def _produce(self):
+        source = self.source_start
+        while source < len(self.audio):
+            with self._condition:
+                # Stay at most `lookahead` ahead of what has been played
+                self._condition.wait_for(
+                    lambda: self._stopped or self._ready_until - self._playhead < self.lookahead_samples)
+                if self._stopped:
+                    return
+
+            end = min(source + self.chunk_samples, len(self.audio))
+            offset, region = stretch_region(self.audio, self.sr, self.tempo_ratio, source, end,
+                                            key=self.key, cache=self.cache)
+
+            with self._condition:
+                self._chunks.append((offset, region))
+                self._ready_until = offset + len(region)
+                self._condition.notify_all()
+            source = end
+
+        with self._condition:
+            self._ready_until = self.length
+            self._condition.notify_all()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop = index.start, min(index.stop, self.length)
+        if stop > self._ready_until:
+            raise Underrun(f"samples up to {stop} requested, {self._ready_until} ready")
+
+        block = np.zeros(max(0, stop - start), dtype=np.float32)
+        with self._condition:
+            for offset, region in self._chunks:
+                lo = max(start, offset)
+                hi = min(stop, offset + len(region))
+                if lo < hi:
+                    block[lo - start:hi - start] = region[lo - offset:hi - offset]
+
+            # Keep a second of history for EQ warm-up, drop anything older
+            while self._chunks and self._chunks[0][0] + len(self._chunks[0][1]) < start - self.sr:
+                self._chunks.popleft()
+
+            self._playhead = max(self._playhead, stop)
+            self._condition.notify_all()
+
+        return block
+
+
+class NullSink:
+    """Discards every block, for headless runs and tests."""
+
+    def write(self, block):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """Writes every block to an audio file."""
+
+    def __init__(self, output_file, sr, subtype=None):
+        import soundfile as sf
+
+        self.file = sf.SoundFile(output_file, "w", samplerate=sr, channels=1, subtype=subtype)
+
+    def write(self, block):
+        self.file.write(block)
+
+    def close(self):
+        self.file.close()
+
+
+class SoundDeviceSink:
+    """Plays blocks on the default output device, needs the optional sounddevice package."""
+
+    def __init__(self, sr, block_size=512):
+        import sounddevice
+
+        self.stream = sounddevice.OutputStream(samplerate=sr, channels=1, dtype="float32", blocksize=block_size)
+        self.stream.start()
+
+    def write(self, block):
+        # Blocks until the device has room, which paces the engine
+        self.stream.write(block.reshape(-1, 1))
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+class LiveEngine:
+    """
+    Mixes decks one fixed-size block at a time within a per-block time budget.
+
+    Args:
+        decks: The Decks to play, as built for render_mix.
+        sr: The sample rate.
+        sink: Where the blocks go, defaults to a NullSink.
+        block_size: Frames per callback.
+    """
+
+    def __init__(self, decks, sr, sink=None, block_size=512):
+        self.decks = decks
+        self.sr = sr
+        self.sink = sink if sink is not None else NullSink()
+        self.block_size = block_size
+        self.budget = block_size / sr
+        self.end = max(deck.end for deck in decks)
+        self.position = 0
+        self.underruns = 0
+        self.deadline_misses = 0
+        self.latencies = []
+        # Fade gains are written here, so callbacks do not allocate for them
+        self.scratch = np.empty(block_size, dtype=np.float32)
+
+        # Load the EQ backend now so the import does not land in the first callback
+        import scipy.signal  # noqa: F401
+
+    def callback(self, out):
+        """Fill `out` with the next block of the mix, as an audio device callback would."""
+        start = time.perf_counter()
+
+        out[:] = 0
+        for deck in self.decks:
+            try:
+                deck.mix_into(out, self.position, self.scratch)
+            except Underrun:
+                # The deck stays silent for this block rather than stalling the others
+                self.underruns += 1
+        self.position += len(out)
+
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        if latency > self.budget:
+            self.deadline_misses += 1
+        return out
+
+    def run(self, realtime=False):
+        """
+        Play until every deck has ended and return the stats.
+
+        With `realtime` the blocks are paced to the wall clock, for sinks that do not
+        block by themselves.
+        """
+        block = np.zeros(self.block_size, dtype=np.float32)
+        deadline = time.perf_counter()
+        try:
+            while self.position < self.end:
+                out = block[:min(self.block_size, self.end - self.position)]
+                self.sink.write(self.callback(out))
+                if realtime:
+                    deadline += len(out) / self.sr
+                    time.sleep(max(0.0, deadline - time.perf_counter()))
+        finally:
+            self.sink.close()
+        return self.stats()
+
+    def stats(self):
+        """Underruns, missed deadlines and callback latency in milliseconds."""
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "blocks": len(latencies),
+            "underruns": self.underruns,
+            "deadline_misses": self.deadline_misses,
+            "budget_ms": self.budget * 1000,
+            "latency_mean_ms": float(latencies.mean()) if len(latencies) else 0.0,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            "latency_max_ms": float(latencies.max()) if len(latencies) else 0.0,
+        }
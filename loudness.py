@@ -0,0 +1,235 @@
+"""
+Streaming loudness measurement and peak limiting for the finished mix.
+
+Loudness is measured as gated, K-weighted loudness in the style of ITU-R BS.1770, one
+block at a time, so it can run while the mix is rendered:
+
+    meter = LoudnessMeter(sr)
+    render_mix(decks, raw_file, sr, subtype="FLOAT", meter=meter)
+    normalize_loudness(raw_file, output_file, loudness=meter.integrated())
+
+normalize_loudness() then applies the gain and a look-ahead limiter in a single pass,
+so the mix is never in memory whole.
+"""
+
+import math
+
+import numpy as np
+
+from instrumentation import span
+
+# Loudness of blocks that never count, and how far below the ungated mean the relative gate sits
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+
+
+def k_weighting_sos(sr):
+    """Second-order sections of the BS.1770 K-weighting filter (high shelf, then high-pass) at any rate."""
+    # High shelf modelling the acoustic effect of the head
+    k = math.tan(math.pi * 1681.974450955533 / sr)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    # High-pass removing the lowest frequencies
+    k = math.tan(math.pi * 38.13547087602444 / sr)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    highpass = [1, -2, 1, 1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+    return np.array([shelf, highpass])
+
+
+def _lufs(mean_square):
+    return -0.691 + 10 * np.log10(np.maximum(mean_square, 1e-20))
+
+
+class LoudnessMeter:
+    """
+    Measures the integrated loudness of a mono signal fed to it block by block.
+
+    Only the energy of every 100 ms step is kept, 400 ms gating blocks overlap by 75%.
+
+    Args:
+        sr: The sample rate.
+    """
+
+    def __init__(self, sr):
+        import scipy.signal
+
+        self._sosfilt = scipy.signal.sosfilt
+        self.sr = sr
+        self.sos = k_weighting_sos(sr)
+        self.step = int(round(0.1 * sr))
+        self._zi = np.zeros((len(self.sos), 2))
+        self._steps = []
+        self._partial = 0.0
+        self._partial_samples = 0
+
+    def process(self, block):
+        """Add the next block of the signal."""
+        if len(block) == 0:
+            return
+        weighted, self._zi = self._sosfilt(self.sos, block, zi=self._zi)
+        energy = np.square(weighted, out=weighted)
+
+        # Complete the step that was started by the previous block
+        needed = self.step - self._partial_samples
+        if len(energy) < needed:
+            self._partial += float(energy.sum())
+            self._partial_samples += len(energy)
+            return
+        self._steps.append(self._partial + float(energy[:needed].sum()))
+
+        rest = energy[needed:]
+        full = len(rest) // self.step * self.step
+        self._steps.extend(rest[:full].reshape(-1, self.step).sum(axis=1).tolist())
+        self._partial = float(rest[full:].sum())
+        self._partial_samples = len(rest) - full
+
+    def block_loudness(self):
+        """Loudness of every 400 ms gating block so far, in LUFS."""
+        steps = np.array(self._steps)
+        if len(steps) < 4:
+            return np.array([])
+        blocks = np.convolve(steps, np.ones(4), mode="valid") / (4 * self.step)
+        return _lufs(blocks)
+
+    def integrated(self):
+        """Gated integrated loudness of everything processed so far, in LUFS (-inf if too short or silent)."""
+        loudness = self.block_loudness()
+        loudness = loudness[loudness > ABSOLUTE_GATE]
+        if len(loudness) == 0:
+            return -math.inf
+
+        # Average energies, not decibels
+        energies = 10 ** ((loudness + 0.691) / 10)
+        relative_gate = _lufs(energies.mean()) + RELATIVE_GATE
+        return float(_lufs(energies[loudness > relative_gate].mean()))
+
+
+class Limiter:
+    """
+    Look-ahead peak limiter that keeps every output sample within `ceiling`.
+
+    The gain needed by each sample is known `lookahead` seconds early, so it is ramped
+    down over that time instead of clipping, held for `hold` seconds and ramped back up.
+    The output is delayed by `latency` samples, flush() returns the tail.
+
+    Args:
+        sr: The sample rate.
+        ceiling: Highest output peak in dBFS.
+        lookahead: Length of the gain ramps in seconds.
+        hold: How long the gain stays down after a peak, in seconds.
+    """
+
+    def __init__(self, sr, ceiling=-1.0, lookahead=0.005, hold=0.05):
+        self.threshold = 10 ** (ceiling / 20)
+        self.latency = max(1, int(round(lookahead * sr)))
+        self.window = self.latency + 1 + int(round(hold * sr))
+
+        # The delayed signal and the required gains the next block still needs
+        self._delayed = np.zeros(self.latency, dtype=np.float32)
+        self._required = np.ones(self.window + self.latency - 2, dtype=np.float32)
+        self.reduction = 0.0
+
+    def process(self, block):
+        """Limit the next block, returns as many samples, delayed by `latency`."""
+        from scipy.ndimage import minimum_filter1d
+
+        if len(block) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        block = np.asarray(block, dtype=np.float32)
+        peaks = np.abs(block)
+        required = np.minimum(1, self.threshold / np.maximum(peaks, 1e-12)).astype(np.float32)
+        required = np.concatenate((self._required, required))
+
+        # Lowest gain required in each run of `window` samples, a centred running minimum shifted to the start
+        half = self.window // 2
+        lowest = minimum_filter1d(required, self.window)[half:half + len(required) - self.window + 1]
+
+        # Averaging over `latency` samples ramps the gain, never above what the delayed sample needs
+        total = np.concatenate(([0.0], np.cumsum(lowest, dtype=np.float64)))
+        gain = (total[self.latency:] - total[:-self.latency]) / self.latency
+
+        delayed = np.concatenate((self._delayed, block))
+        out = (delayed[:len(block)] * gain).astype(np.float32)
+
+        self._delayed = delayed[len(block):]
+        self._required = required[len(required) - len(self._required):]
+        self.reduction = min(self.reduction, float(20 * np.log10(max(gain.min(), 1e-12))))
+        return out
+
+    def flush(self):
+        """Return the last `latency` samples still held back."""
+        return self.process(np.zeros(self.latency, dtype=np.float32))
+
+
+def limit_blocks(blocks, sr, gain=1.0, ceiling=-1.0, lookahead=0.005, hold=0.05):
+    """
+    Apply a gain and the limiter to a stream of blocks, e.g. sf.blocks() or slices of a memory map.
+
+    Yields output blocks of the same total length as the input, the limiter's delay
+    is compensated.
+    """
+    limiter = Limiter(sr, ceiling, lookahead, hold)
+    skip = limiter.latency
+    for block in blocks:
+        out = limiter.process(np.asarray(block, dtype=np.float32) * np.float32(gain))
+        if skip:
+            dropped = min(skip, len(out))
+            out = out[dropped:]
+            skip -= dropped
+        if len(out):
+            yield out
+    tail = limiter.flush()
+    yield tail[skip:]
+
+
+def measure_loudness(input_file, block_size=65536):
+    """Integrated loudness of a mono audio file in LUFS, read block by block."""
+    import soundfile as sf
+
+    meter = LoudnessMeter(sf.info(input_file).samplerate)
+    for block in sf.blocks(input_file, blocksize=block_size, dtype="float32"):
+        meter.process(block)
+    return meter.integrated()
+
+
+def normalize_loudness(input_file, output_file, target=-10.0, ceiling=-1.0, loudness=None, block_size=65536,
+                       subtype=None):
+    """
+    Bring a mono audio file to a target loudness with a look-ahead limiter, block by block.
+
+    Args:
+        input_file: The file to normalise, e.g. a mix rendered as float.
+        output_file: Where the result is written.
+        target: Target integrated loudness in LUFS.
+        ceiling: Highest output peak in dBFS.
+        loudness: Loudness of the input if it was measured while rendering, otherwise
+            the file is measured first.
+        block_size: Samples read and written at a time.
+        subtype: Sample format of the output file.
+
+    Returns:
+        The gain applied in dB.
+    """
+    import soundfile as sf
+
+    with span("loudness.normalize_loudness") as s:
+        if loudness is None:
+            loudness = measure_loudness(input_file, block_size)
+        gain_db = target - loudness if math.isfinite(loudness) else 0.0
+
+        info = sf.info(input_file)
+        with sf.SoundFile(output_file, "w", samplerate=info.samplerate, channels=1, subtype=subtype) as out:
+            for block in limit_blocks(sf.blocks(input_file, blocksize=block_size, dtype="float32"),
+                                      info.samplerate, 10 ** (gain_db / 20), ceiling):
+                out.write(block)
+        s.add(samples=info.frames)
+
+    return gain_db
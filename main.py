@@ -1,81 +1,108 @@
+import argparse
 import os
 from track import *
+import instrumentation
+from alignment import find_alignment
+from cache import AnalysisCache
+from ingest import ingest_tracks
+from library import Library
+from planner import plan_set
 from visualisations import plot_waveform_with_hot_cues
 from tempo import adjust_tempo_and_analyze
-from eq import create_eq_adjusted_tracks, create_eq_adjusted_tracks_treble, beats_to_seconds, normalize_audio_gain
-from IPython.display import Audio
-from mixing import combine_tracks
-import soundfile as sf
+from eq import bass_swap_envelopes, treble_swap_envelopes, beats_to_seconds
+from loudness import LoudnessMeter, normalize_loudness
+from mixing import render_mix, transition_decks
 
 
 
-def main():
+def main(workers=0):
     # specify your path
     path = "raw-wavs"
 
-    raw_wav_files = []
-
-    for file_name in os.listdir(path):
-        if file_name.endswith('.wav'):
-            raw_wav_files.append(os.path.join(path, file_name))
-
-    raw_tracks = {}
-
-    for wav_file in raw_wav_files:
-        track_name = os.path.splitext(os.path.basename(wav_file))[0]
-        track = Track(track_name, wav_file)
-        raw_tracks[track_name] = track
-
-    new_tracks = {}
-    counter = {}
-
-    for old_key, track in raw_tracks.items():
-        new_key = old_key.split()[0]
-        if new_key in counter:
-            counter[new_key] += 1
-            new_key = f"{new_key}{counter[new_key]}"
-        else:
-            counter[new_key] = 1
-        new_tracks[new_key] = track
-
-    tracks = new_tracks
-
-    """
-    for name, track in tracks.items():
-        print(f"Preprocessing : {name}:")
-        preprocess(track)
-    """
-    for name, track in tracks.items():
-        if name == "Bours-" or name == "JKS":
-            print(f"Preprocessing : {name}:")
-            preprocess(track)
+    # Analysis results are reused across runs as long as the files and parameters are unchanged,
+    # decoded audio is kept there too and memory-mapped on later runs
+    cache = AnalysisCache()
+
+    # Only files that are new or changed since the last run get hashed, IDs stay the same across runs
+    library = Library(path)
+    added, changed, removed = library.scan()
+    print(f"Library: {len(library)} tracks, {len(added)} new, {len(changed)} changed, {len(removed)} removed")
+
+    # Tracks only decode their audio when it is first used
+    tracks = library.tracks(cache=cache)
+
+    if workers:
+        # Only tracks without a cached analysis go to the process pool, only the analysis records come back
+        pending = {name: track.wav_file for name, track in tracks.items()
+                   if not load_cached_analysis(track, cache)}
+        records, failures = ingest_tracks(pending, workers=workers, cache_dir=cache.directory)
+        for name, record in records.items():
+            tracks[name].load_analysis(record)
+        if failures:
+            print(f"{len(failures)} track(s) failed to analyse: {', '.join(failures)}")
+
+        # With the whole folder analysed, suggest an order for the full set
+        analysed = {name: track for name, track in tracks.items() if track.tempo is not None}
+        set_order, set_cost = plan_set(analysed)
+        print(f"Planned set (cost {set_cost:.2f}): {' -> '.join(set_order)}")
+    else:
+        for name, track in tracks.items():
+            if name == "Bours-" or name == "JKS":
+                print(f"Preprocessing : {name}:")
+                preprocess(track, cache=cache)
 
 
     a = tracks['Bours-']
     c = tracks['JKS']
 
-    adjusted_ca = adjust_tempo_and_analyze("Bours-", "JKS", tracks)
+    # Only the part of JKS from its cue point onwards is played, so only that part is stretched
+    stretch_start = c.cue_points_rms[2]
+    adjusted_ca = adjust_tempo_and_analyze("Bours-", "JKS", tracks, cache=cache, start=stretch_start)
 
     b = tracks['JKS_AT_149bpm']
 
-    plot_waveform_with_hot_cues(a.audio, a.sr, a.cue_points_rms)
-    plot_waveform_with_hot_cues(b.audio, b.sr, b.cue_points_rms)
+    plot_waveform_with_hot_cues(a.audio, a.sr, a.cue_points_rms, overview=a.waveform_overview())
+    plot_waveform_with_hot_cues(b.audio, b.sr, b.cue_points_rms, overview=b.waveform_overview())
 
     seconds = beats_to_seconds(a.tempo, 8)
-    acue = a.cue_points_rms[4]
-    bcue = b.cue_points_rms[2]
-    bbass = b.cue_points_rms[4]
+
+    # Score every pairing of cue points and beat offset instead of using fixed cue indices.
+    # The stretched JKS is silent before its stretch start, so only cue points after it are candidates
+    stretched_start = stretch_start / (a.tempo / c.tempo)
+    acue, bcue, lag = find_alignment(a, b, cues_b=b.cue_points_rms[b.cue_points_rms >= stretched_start])
+    acue += lag
+    print(f"Aligned {b.name} at {bcue:.2f}s to {a.name} at {acue:.2f}s")
+
+    # Swap the bass at the second cue point after the incoming one, as with the fixed indices before
+    later = b.cue_points_rms[b.cue_points_rms > bcue]
+    bbass = later[1] if len(later) > 1 else bcue + 2 * seconds
     abass = acue + (bbass - bcue - seconds)
 
-    track1_eq, track2_eq = create_eq_adjusted_tracks(a.audio, b.audio, abass, bbass, a.sr)
-    a_both_eq, b_both_eq = create_eq_adjusted_tracks_treble(track1_eq, track2_eq, bcue, bcue, 120, a.sr)
+    a_bass, b_bass = bass_swap_envelopes(abass, bbass)
+    a_treble, b_treble = treble_swap_envelopes(bcue, bcue, 120)
+    decks = transition_decks(a.audio, b.audio, acue, bcue, a.sr, eq1=[a_bass, a_treble], eq2=[b_bass, b_treble])
 
-    combined = combine_tracks(a_both_eq, b_both_eq, acue, bcue, a.sr)
-    combined_normalized = normalize_audio_gain(combined)
+    # Stream the mix to disk block by block while measuring its loudness,
+    # then bring it to the target loudness through the limiter in one more pass
+    output_file = 'Boursy_mixed_with_JKS_at_149bpm.wav'
+    raw_file = f"{os.path.splitext(output_file)[0]}_raw.wav"
+    meter = LoudnessMeter(a.sr)
+    render_mix(decks, raw_file, a.sr, subtype='FLOAT', meter=meter)
+    print(f"Mix loudness: {meter.integrated():.1f} LUFS")
+    normalize_loudness(raw_file, output_file, loudness=meter.integrated())
+    os.remove(raw_file)
 
-    sf.write('Boursy_mixed_with_JKS_at_149bpm.wav', combined_normalized, a.sr)
-    Audio(combined_normalized, rate=a.sr)
+    instrumentation.report()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Analyse the raw-wavs folder and render a mix.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="analyse every track in a pool of this many processes (0 = sequential)")
+    parser.add_argument("--instrument", choices=["off", "summary", "trace"], default=None,
+                        help="time every stage and print a summary or write a trace file")
+    parser.add_argument("--trace-file", default=None, help="where to write the trace (default trace.json)")
+    args = parser.parse_args()
+    if args.instrument is not None:
+        instrumentation.configure(args.instrument, args.trace_file)
+    main(workers=args.workers)
@@ -1,48 +1,205 @@
 """Mixing-related functions."""
 
+from functools import lru_cache
+
 import numpy as np
 
+from eq import EQRenderer
+from instrumentation import span
+
 
 def crossfade_tracks(track1, track2, cue_points1, cue_points2, crossfade_duration, sr):
     """Crossfade between two tracks at specified cue points."""
-    crossfade_cue_point1 = cue_points1
-    crossfade_cue_point2 = cue_points2
-
-    # Cut the tracks at the cue points
-    track1_cut = track1[:int(crossfade_cue_point1 * sr)]
-    track2_cut = track2[int(crossfade_cue_point2 * sr):]
-
-    # Crossfade
-    crossfade = np.linspace(0, 1, int(crossfade_duration * sr))
-    track1_fadeout = track1_cut[-len(crossfade):] * (1 - crossfade)
-    track2_fadein = track2_cut[:len(crossfade)] * crossfade
+    # track1 fades out over the samples before its cue point while track2 fades in from its cue point
+    cue_point1_samples = int(cue_points1 * sr)
+    cue_point2_samples = int(cue_points2 * sr)
+    fade_samples = int(crossfade_duration * sr)
+    fade_start = (cue_point1_samples - fade_samples) / sr
+    fade_in = cue_point2_samples / sr
 
-    # Combine the tracks
-    combined = np.concatenate([track1_cut[:-len(crossfade)], track1_fadeout + track2_fadein, track2_cut[len(crossfade):]])
+    deck1 = Deck(track1, sr, length=cue_point1_samples / sr,
+                 fade=([fade_start, (cue_point1_samples - 1) / sr], [1, 0]))
+    deck2 = Deck(track2, sr, start=fade_start, offset=fade_in,
+                 fade=([fade_in, (cue_point2_samples + fade_samples - 1) / sr], [0, 1]))
 
-    return combined
+    return MixBus([deck1, deck2]).render()
 
 
 def combine_tracks(track1, track2, cue_point1, cue_point2, sr):
     """Combine two tracks at specified cue points."""
-    # Convert cue points from seconds to samples
+    with span("mixing.combine_tracks", samples=len(track1) + len(track2)):
+        return MixBus(transition_decks(track1, track2, cue_point1, cue_point2, sr)).render()
+
+
+@lru_cache(maxsize=64)
+def fade_shape(length):
+    """Read-only ramp from 0 to 1 over `length` samples, shared by every fade of that length."""
+    shape = np.arange(length + 1, dtype=np.float32) / np.float32(length)
+    shape.flags.writeable = False
+    return shape
+
+
+class Deck:
+    """
+    A source placed on the mix timeline.
+
+    Args:
+        audio: The source samples.
+        sr: The sample rate.
+        start: Time in the mix (seconds) at which the deck starts playing.
+        offset: Time in the source (seconds) that plays at `start`.
+        length: How many seconds to play, defaults to the rest of the source.
+        eq: Optional EQEnvelope or list of them, in source time.
+        fade: Optional (times, gains) pair, in source time. The gain is linearly
+            interpolated between the points and held before the first and after the last.
+            The times are rounded to whole samples.
+    """
+
+    def __init__(self, audio, sr, start=0.0, offset=0.0, length=None, eq=None, fade=None):
+        self.audio = audio
+        self.sr = sr
+        self.start = int(round(start * sr))
+        self.offset = int(round(offset * sr))
+        available = len(audio) - self.offset
+        self.end = self.start + (available if length is None else min(int(round(length * sr)), available))
+        self.eq = EQRenderer(sr, eq) if eq is not None else None
+        self.fade = fade
+        if fade is not None:
+            times, gains = fade
+            self._fade_positions = np.round(np.asarray(times, dtype=np.float64) * sr).astype(np.int64)
+            self._fade_gains = np.asarray(gains, dtype=np.float32)
+
+    def _fade_gain(self, gain, source_start):
+        # Fill gain with the fade of the source samples from source_start, piece by piece
+        positions, gains = self._fade_positions, self._fade_gains
+        done = 0
+        while done < len(gain):
+            sample = source_start + done
+            i = np.searchsorted(positions, sample, side="right")
+            if i == 0:
+                stop = min(len(gain), positions[0] - source_start)
+                gain[done:stop] = gains[0]
+            elif i == len(positions):
+                stop = len(gain)
+                gain[done:stop] = gains[-1]
+            else:
+                first, last = positions[i - 1], positions[i]
+                stop = min(len(gain), last - source_start)
+                ramp = fade_shape(int(last - first))[sample - first:sample - first + stop - done]
+                np.multiply(ramp, gains[i] - gains[i - 1], out=gain[done:stop])
+                gain[done:stop] += gains[i - 1]
+            done = stop
+
+    def mix_into(self, out, position, scratch=None):
+        """
+        Adds the deck's contribution to mix samples [position, position + len(out)) into out.
+
+        A float32 `scratch` buffer at least as long as out avoids allocating for the fade.
+        """
+        first = max(position, self.start)
+        last = min(position + len(out), self.end)
+        if first >= last:
+            return
+
+        source_start = self.offset + first - self.start
+        source_end = source_start + last - first
+        block = self.audio[source_start:source_end]
+
+        if self.eq is not None:
+            if self.eq.position != source_start:
+                # Run the filters over the preceding samples so the deck does not start on a transient
+                warmup = max(0, source_start - self.eq.block_size)
+                self.eq.process(self.audio[warmup:source_start], warmup)
+            block = self.eq.process(block, source_start)
+
+        if self.fade is not None:
+            if scratch is None or len(scratch) < len(block):
+                scratch = np.empty(len(block), dtype=np.float32)
+            gain = scratch[:len(block)]
+            self._fade_gain(gain, source_start)
+            block = np.multiply(block, gain, out=gain)
+
+        out[first - position:last - position] += block
+
+
+def transition_decks(track1, track2, cue_point1, cue_point2, sr, eq1=None, eq2=None):
+    """Returns the decks that reproduce combine_tracks, optionally with EQ envelopes."""
     cue_point1_samples = int(cue_point1 * sr)
     cue_point2_samples = int(cue_point2 * sr)
 
-    # Cut the tracks at the cue points
-    track1_part1 = track1[:cue_point1_samples]
-    track1_part2 = track1[cue_point1_samples:]
-    track2_part = track2[cue_point2_samples:]
+    # Like combine_tracks, the mix ends with the shorter of the two overlapping parts
+    overlap = min(len(track1) - cue_point1_samples, len(track2) - cue_point2_samples)
+    length = (cue_point1_samples + overlap) / sr
+
+    # track1 plays alone until its cue point, then both tracks play at half gain
+    step = ([(cue_point1_samples - 1) / sr, cue_point1_samples / sr], [1, 0.5])
+    deck1 = Deck(track1, sr, start=0, length=length, eq=eq1, fade=step)
+    deck2 = Deck(track2, sr, start=cue_point1_samples / sr, offset=cue_point2_samples / sr, length=overlap / sr,
+                 eq=eq2, fade=([0], [0.5]))
+
+    return deck1, deck2
+
+
+class MixBus:
+    """
+    Sums any number of decks into one preallocated float32 buffer.
+
+    The mix block and a scratch buffer for the fades are allocated once. Every deck adds
+    into the block in place, so three or more overlapping decks cost no extra copies.
+
+    Args:
+        decks: The Decks to mix.
+        block_size: Samples mixed per block.
+    """
+
+    def __init__(self, decks, block_size=65536):
+        self.decks = list(decks)
+        self.block_size = block_size
+        self.end = max(deck.end for deck in self.decks)
+        self.block = np.empty(block_size, dtype=np.float32)
+        self.scratch = np.empty(block_size, dtype=np.float32)
+
+    def mix_into(self, out, position):
+        """Overwrites out with mix samples [position, position + len(out)) and returns it."""
+        out[:] = 0
+        for deck in self.decks:
+            deck.mix_into(out, position, self.scratch)
+        return out
+
+    def blocks(self):
+        """Yields (position, block) pairs over the whole mix, the block buffer is reused."""
+        for position in range(0, self.end, self.block_size):
+            yield position, self.mix_into(self.block[:min(self.block_size, self.end - position)], position)
+
+    def render(self, out=None):
+        """Mixes everything into out, or a new float32 buffer of the mix length, and returns it."""
+        if out is None:
+            out = np.empty(self.end, dtype=np.float32)
+        for position in range(0, self.end, self.block_size):
+            self.mix_into(out[position:position + self.block_size], position)
+        return out
+
+
+def render_mix(decks, output_file, sr, block_size=65536, subtype=None, meter=None):
+    """
+    Renders decks block by block straight into an audio file.
+
+    Only one block of the mix is in memory at a time, so memory use does not depend on
+    the length of the mix. An optional loudness.LoudnessMeter measures every block as
+    it is written.
 
-    # Make the overlapping parts the same length
-    min_length = min(len(track1_part2), len(track2_part))
-    track1_part2 = track1_part2[:min_length]
-    track2_part = track2_part[:min_length]
+    Returns:
+        The length of the mix in seconds.
+    """
+    import soundfile as sf
 
-    # Mix the overlapping parts of the tracks
-    combined_part = (track1_part2 + track2_part) / 2
+    bus = MixBus(decks, block_size)
 
-    # Combine all the parts
-    combined = np.concatenate([track1_part1, combined_part, track2_part[min_length:]])
+    with span("mixing.render_mix", samples=bus.end, decks=len(bus.decks)), \
+            sf.SoundFile(output_file, "w", samplerate=sr, channels=1, subtype=subtype) as out:
+        for _, block in bus.blocks():
+            out.write(block)
+            if meter is not None:
+                meter.process(block)
 
-    return combined
+    return bus.end / sr
@@ -0,0 +1,138 @@
+"""Ordering a whole folder of analysed tracks into a DJ set."""
+
+import numpy as np
+
+# Cost of a transition that should never be picked when anything else is possible
+FORBIDDEN = 1e6
+
+
+def _field(track, name):
+    """Read an analysis field from a Track or from an analysis record dict."""
+    return track[name] if isinstance(track, dict) else getattr(track, name)
+
+
+def transition_costs(tracks, out_cue_index=4, in_cue_index=4, max_stretch=0.08,
+                     tempo_weight=10.0, phrase_weight=1.0):
+    """
+    Build the matrix of transition costs between every pair of tracks.
+
+    Args:
+        tracks: A dict mapping names to analysed Tracks or analysis records.
+        out_cue_index: Cue point the outgoing track mixes out at, it needs that many cue points.
+        in_cue_index: Highest cue point the incoming track uses (the bass swap in main()).
+        max_stretch: Largest tempo change, as a fraction, that is allowed without penalty.
+        tempo_weight: Weight of the tempo change.
+        phrase_weight: Weight of how scattered the cue points are over the four beat series.
+
+    Returns:
+        A tuple (names, costs) where costs[i, j] is the cost of mixing from names[i] into names[j].
+    """
+    names = list(tracks)
+    tempos = np.array([_field(tracks[name], "tempo") for name in names], dtype=np.float64)
+    cue_counts = np.array([len(_field(tracks[name], "cue_points_rms")) for name in names])
+    series = np.array([_field(tracks[name], "cue_point_counts") for name in names], dtype=np.float64)
+
+    # How much the incoming track has to be stretched to match the outgoing one
+    stretch = np.abs(np.log(tempos[:, np.newaxis] / tempos[np.newaxis, :]))
+    costs = tempo_weight * stretch
+    costs[stretch > np.log1p(max_stretch)] += FORBIDDEN
+
+    # Tracks whose cue points mostly fall on one beat series phrase cleanly
+    clarity = series.max(axis=1) / np.maximum(series.sum(axis=1), 1)
+    costs += phrase_weight * ((1 - clarity)[:, np.newaxis] + (1 - clarity)[np.newaxis, :]) / 2
+
+    # Both tracks need the cue points the transition uses
+    costs[cue_counts <= out_cue_index, :] += FORBIDDEN
+    costs[:, cue_counts <= in_cue_index] += FORBIDDEN
+
+    np.fill_diagonal(costs, FORBIDDEN)
+    return names, costs
+
+
+def order_cost(costs, order):
+    """Total cost of playing the tracks in the given order."""
+    order = np.asarray(order)
+    return float(costs[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbour_order(costs, start):
+    """Greedy order that always mixes into the cheapest track not played yet."""
+    n = len(costs)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, costs[order[-1]])
+        order.append(int(np.argmin(row)))
+        visited[order[-1]] = True
+
+    return order
+
+
+def improve_order(costs, order, max_iterations=None):
+    """
+    Improve an order by reversing segments while that lowers the total cost.
+
+    Every possible reversal is scored at once. The costs are not symmetric, so the edges
+    inside a reversed segment are re-priced using prefix sums of the backward edges.
+    """
+    n = len(costs)
+    if n < 3:
+        return list(order)
+    max_iterations = max_iterations if max_iterations is not None else 10 * n
+
+    # A free dummy track at both ends lets the first and last tracks move too
+    padded = np.zeros((n + 1, n + 1))
+    padded[:n, :n] = costs
+    path = np.concatenate(([n], order, [n]))
+
+    lo, hi = np.triu_indices(len(path) - 2, k=1)
+    lo, hi = lo + 1, hi + 1
+
+    for _ in range(max_iterations):
+        forward = padded[path[:-1], path[1:]]
+        backward = padded[path[1:], path[:-1]]
+        forward_sum = np.concatenate(([0], np.cumsum(forward)))
+        backward_sum = np.concatenate(([0], np.cumsum(backward)))
+
+        # Change in cost of reversing path[lo:hi + 1]
+        delta = (padded[path[lo - 1], path[hi]] + padded[path[lo], path[hi + 1]]
+                 - forward[lo - 1] - forward[hi]
+                 + (backward_sum[hi] - backward_sum[lo]) - (forward_sum[hi] - forward_sum[lo]))
+
+        best = np.argmin(delta)
+        if delta[best] >= -1e-9:
+            break
+        path[lo[best]:hi[best] + 1] = path[lo[best]:hi[best] + 1][::-1]
+
+    return [int(i) for i in path[1:-1]]
+
+
+def plan_set(tracks, restarts=8, **cost_params):
+    """
+    Find a low-cost order for a whole folder of tracks.
+
+    Args:
+        tracks: A dict mapping names to analysed Tracks or analysis records.
+        restarts: Number of starting tracks tried for the greedy order.
+        **cost_params: Forwarded to transition_costs().
+
+    Returns:
+        A tuple (order, cost) with the track names in playing order and the total cost.
+    """
+    names, costs = transition_costs(tracks, **cost_params)
+    if len(names) < 2:
+        return names, 0.0
+
+    # Start from the tracks that are cheapest to mix out of
+    starts = np.argsort(np.sort(costs, axis=1)[:, 0])[:restarts]
+
+    best_order, best_cost = None, np.inf
+    for start in starts:
+        order = improve_order(costs, nearest_neighbour_order(costs, int(start)))
+        cost = order_cost(costs, order)
+        if cost < best_cost:
+            best_order, best_cost = order, cost
+
+    return [names[i] for i in best_order], best_cost
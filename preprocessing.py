@@ -1,54 +1,177 @@
 """Preprocessing functions."""
 
 import numpy as np
-import librosa
-import madmom
-from scipy.stats import mode
-from essentia.standard import BeatTrackerMultiFeature, MonoLoader
-from itertools import groupby
-from operator import itemgetter
-import essentia
 
-from file_load_conversion import main as load_conversion
+# librosa, madmom, essentia and scipy are slow to import, so each function imports
+# the backend it needs when it first runs rather than when this module is loaded.
 
 
-def calculate_beats_multifeature(audio_file):
-    """Calculate the beats of an audio file using Essentia's multi-feature beat tracker."""
-    # Load the audio
-    loader = MonoLoader(filename=audio_file, resampleQuality=0)
-    audio = loader()
+class Analyser:
+    """
+    Holds initialised madmom and Essentia processors so they are built once per process.
 
-    # Initialize the BeatTrackerMultiFeature
-    tracker = BeatTrackerMultiFeature()
+    Loading the RNN downbeat ensemble is a fixed cost per instance, so use get_analyser()
+    to share one instance per process (or per pool worker) rather than creating new ones.
+    """
 
-    # Calculate the beats
-    beats, _ = tracker(audio)
+    def __init__(self, fps=100):
+        self.fps = fps
+        self._downbeat_activations = None
+        self._downbeat_tracker = None
+        self._beat_tracker = None
 
-    return beats
+    def _downbeat_processors(self):
+        # Built on first use, so tracks that only need beats never load the RNNs
+        if self._downbeat_activations is None:
+            import madmom
 
+            self._downbeat_activations = madmom.features.RNNDownBeatProcessor()
+            self._downbeat_tracker = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[4], fps=self.fps)
+        return self._downbeat_activations, self._downbeat_tracker
 
-def detect_downbeats(audio_file, sr=44100, fps=100):
-    """Detect the downbeats of an audio file using madmom's DBNDownBeatTrackingProcessor."""
-    # Load the audio signal without resampling
-    signal = madmom.audio.signal.Signal(audio_file, sample_rate=sr, num_channels=1)
+    def downbeat_activations(self, audio, sr=44100):
+        """Compute the RNN beat and downbeat activations of a mono signal."""
+        import madmom
 
-    # Get the beat and downbeat activations
-    act = madmom.features.RNNDownBeatProcessor()(signal)
+        activations, _ = self._downbeat_processors()
 
-    # Create a downbeat processor
-    proc = madmom.features.DBNDownBeatTrackingProcessor(beats_per_bar=[4], fps=fps)
+        # Wrap the already decoded samples, madmom does not need to read the file again
+        signal = madmom.audio.signal.Signal(audio, sample_rate=sr, num_channels=1)
+        return activations(signal)
 
-    # Get the beats and downbeats
-    beats_and_downbeats = proc(act)
+    def downbeats_from_activations(self, act):
+        """Decode downbeat times from RNN activations."""
+        _, tracker = self._downbeat_processors()
 
-    # Filter downbeats (those with beat position 1)
-    downbeats = [beat for beat in beats_and_downbeats if beat[1] == 1]
+        # Get the beats and downbeats
+        beats_and_downbeats = tracker(act)
 
-    return np.array(downbeats)
+        # Filter downbeats (those with beat position 1)
+        downbeats = [beat for beat in beats_and_downbeats if beat[1] == 1]
+
+        return np.array(downbeats)
+
+    def detect_downbeats(self, audio, sr=44100):
+        """Detect the downbeats of a mono signal."""
+        return self.downbeats_from_activations(self.downbeat_activations(audio, sr))
+
+    def calculate_beats_multifeature(self, audio):
+        """Calculate the beats of a mono 44.1 kHz signal."""
+        import essentia
+
+        if self._beat_tracker is None:
+            from essentia.standard import BeatTrackerMultiFeature
+
+            self._beat_tracker = BeatTrackerMultiFeature()
+
+        # Clear any state left over from the previous track
+        self._beat_tracker.reset()
+
+        # Calculate the beats (Essentia expects a contiguous float32 array)
+        beats, _ = self._beat_tracker(essentia.array(audio))
+
+        return beats
+
+
+# One Analyser per fps for the life of the process
+_analysers = {}
+
+
+def get_analyser(fps=100):
+    """Return the process-wide Analyser for the given fps, creating it on first use."""
+    if fps not in _analysers:
+        _analysers[fps] = Analyser(fps=fps)
+    return _analysers[fps]
+
+
+def calculate_beats_multifeature(audio):
+    """Calculate the beats of a mono 44.1 kHz signal using Essentia's multi-feature beat tracker."""
+    return get_analyser().calculate_beats_multifeature(audio)
+
+
+def detect_downbeats(audio, sr=44100, fps=100):
+    """Detect the downbeats of a mono signal using madmom's DBNDownBeatTrackingProcessor."""
+    return get_analyser(fps).detect_downbeats(audio, sr)
+
+
+def _windowed_events(audio, sr, detect, window, overlap):
+    """
+    Run an event detector over overlapping windows and stitch the events into one grid.
+
+    Each window keeps the events in its core, the part not shared with a neighbour's
+    core, so every event comes from a window that saw at least overlap / 2 seconds of
+    context on both sides. Events of neighbouring windows that land closer together
+    than half the median spacing are the same event and only the first is kept.
+    """
+    window_samples = int(window * sr)
+    overlap_samples = int(overlap * sr)
+    step = window_samples - overlap_samples
+    if step <= 0:
+        raise ValueError("The overlap must be shorter than the window")
+
+    starts = list(range(0, max(1, len(audio) - overlap_samples), step))
+    events = []
+    for i, start in enumerate(starts):
+        # Copy the window out so only one window of a memory-mapped file is resident
+        chunk = np.array(audio[start:start + window_samples], dtype=np.float32)
+        found = np.asarray(detect(chunk), dtype=np.float64)
+        if len(found) == 0:
+            continue
+        found = found.copy()
+        times = found[:, 0] if found.ndim > 1 else found
+        times += start / sr
+
+        core_start = 0 if i == 0 else (start + overlap_samples // 2) / sr
+        core_end = np.inf if i == len(starts) - 1 else (start + step + overlap_samples // 2) / sr
+        events.append(found[(times >= core_start) & (times < core_end)])
+
+    if not events:
+        return np.array([])
+    events = np.concatenate(events)
+
+    times = events[:, 0] if events.ndim > 1 else events
+    if len(times) > 2:
+        keep = np.concatenate(([True], np.diff(times) >= np.median(np.diff(times)) / 2))
+        events = events[keep]
+    return events
+
+
+def detect_downbeats_windowed(audio, sr=44100, fps=100, window=300.0, overlap=20.0):
+    """Detect the downbeats of a long signal window by window, see _windowed_events()."""
+    analyser = get_analyser(fps)
+    return _windowed_events(audio, sr, lambda chunk: analyser.detect_downbeats(chunk, sr), window, overlap)
+
+
+def calculate_beats_multifeature_windowed(audio, sr=44100, window=300.0, overlap=20.0):
+    """Calculate the beats of a long mono 44.1 kHz signal window by window, see _windowed_events()."""
+    return _windowed_events(audio, sr, calculate_beats_multifeature, window, overlap)
+
+
+def refine_beats(audio, sr, beats, search_window=0.03, hop_length=128):
+    """Snap each beat to the strongest onset within a small window around it."""
+    import librosa
+
+    # Onset strength of the signal
+    onset_envelope = librosa.onset.onset_strength(y=audio, sr=sr, hop_length=hop_length)
+
+    # Candidate frames around every beat, one row per beat
+    frames = librosa.time_to_frames(beats, sr=sr, hop_length=hop_length)
+    radius = max(1, int(round(search_window * sr / hop_length)))
+    candidates = np.clip(frames[:, np.newaxis] + np.arange(-radius, radius + 1), 0, len(onset_envelope) - 1)
+
+    # Keep the candidate with the strongest onset, beats without a stronger onset nearby stay put
+    strengths = onset_envelope[candidates]
+    choice = np.argmax(strengths, axis=1)
+    choice[strengths[:, radius] >= strengths.max(axis=1)] = radius
+    best = candidates[np.arange(len(frames)), choice]
+
+    return librosa.frames_to_time(best, sr=sr, hop_length=hop_length)
 
 
 def estimate_tempo_from_downbeats(audio_file, downbeats):
     """Estimate the tempo of an audio file based on its downbeats."""
+    from scipy.stats import mode
+
     # Calculate the time difference between consecutive downbeats
     downbeat_differences = np.around(np.diff(downbeats[:, 0]), decimals=6)
 
@@ -64,39 +187,35 @@ def estimate_tempo_from_downbeats(audio_file, downbeats):
     return tempo, mod_diff, downbeat_differences
 
 
-def calculate_rms_transitions_indices(audio, sr, beats, window_size=1024, hop_length=512):
-    """Calculate the RMS transitions between beats and return the indices of the most significant transitions."""
-    # Calculate RMS
-    rms = librosa.feature.rms(y=audio, frame_length=window_size, hop_length=hop_length).squeeze()
+def calculate_rms_transitions_indices(audio, sr, beats, window_size=1024, hop_length=512, percentile=97.5,
+                                      rms=None):
+    """
+    Calculate the RMS transitions between beats and return the indices of the most significant transitions.
 
-    # This will hold our feature transitions and corresponding downbeat indices
-    rms_transitions = []
-    transition_indices = []
+    Frame RMS computed earlier, e.g. from a feature file, can be passed as `rms`, `audio` is then not used.
+    """
+    if rms is None:
+        import librosa
 
-    for i in range(len(beats)):  # Include all downbeats
-        # Identify the frames for the previous, current and next beat
-        prev_frame = int(librosa.time_to_samples(beats[i-1], sr=sr) / hop_length) if i > 0 else None
-        current_frame = int(librosa.time_to_samples(beats[i], sr=sr) / hop_length)
-        next_frame = int(librosa.time_to_samples(beats[i+1], sr=sr) / hop_length) if i < len(beats) - 1 else None
+        # Calculate RMS
+        rms = librosa.feature.rms(y=audio, frame_length=window_size, hop_length=hop_length).squeeze()
 
-        # Calculate the transitions for RMS
-        if prev_frame is not None and next_frame is not None:
-            rms_transition = max(np.abs(rms[current_frame] - rms[prev_frame]), np.abs(rms[current_frame] - rms[next_frame]))
-        elif prev_frame is not None:  # Handle the last downbeat
-            rms_transition = np.abs(rms[current_frame] - rms[prev_frame])
-        else:  # Handle the first downbeat
-            rms_transition = np.abs(rms[current_frame] - rms[next_frame])
+    # RMS frame of every beat, truncated the same way as librosa.time_to_samples
+    beat_frames = (np.asarray(beats) * sr).astype(int) // hop_length
+    beat_rms = rms[beat_frames]
 
-        rms_transitions.append(rms_transition)
-        transition_indices.append(i)
+    # Absolute RMS change between each beat and the next one
+    differences = np.abs(np.diff(beat_rms))
 
-    # Convert to numpy arrays for easier manipulation
-    rms_transitions = np.array(rms_transitions)
-    transition_indices = np.array(transition_indices)
+    # Each beat takes the larger change to its neighbours, the first and last beats only have one
+    rms_transitions = np.empty(len(beat_rms), dtype=rms.dtype)
+    rms_transitions[0] = differences[0]
+    rms_transitions[-1] = differences[-1]
+    np.maximum(differences[:-1], differences[1:], out=rms_transitions[1:-1])
 
     # Identify the indices of the beats with the highest RMS transitions
-    # Here we're choosing the top 10%, but this can be adjusted
-    top_rms_indices = transition_indices[rms_transitions >= np.percentile(rms_transitions, 97.5)]
+    # By default we keep the top 2.5%, this can be adjusted with `percentile`
+    top_rms_indices = np.flatnonzero(rms_transitions >= np.percentile(rms_transitions, percentile))
 
     # Always include the first beat
     top_rms_indices = np.append(0, top_rms_indices)
@@ -109,20 +228,27 @@ def filter_consecutive_indices(indices, rms_transitions, consecutive_index_dista
     if len(indices) <= 4:
         return indices
 
-    filtered_indices = []
+    indices = np.asarray(indices)
+
+    # Runs of consecutive indices share a group number, a new group starts wherever the step is not 1
+    groups = np.concatenate(([0], np.cumsum(np.diff(indices) != 1)))
 
-    for _, group in groupby(enumerate(indices), lambda ix: ix[0] - ix[1]):
-        sequence = list(map(itemgetter(1), group))
-        sequence.sort()
+    # Drop indices past the end of the transitions, then keep the loudest transition of each run
+    valid = indices < len(rms_transitions)
+    indices = indices[valid]
+    groups = groups[valid]
+    if len(indices) == 0:
+        return []
 
-        sequence = [index for index in sequence if index < len(rms_transitions)]
+    amplitudes = rms_transitions[indices]
+    group_starts = np.flatnonzero(np.diff(groups, prepend=-1))
+    group_max = np.maximum.reduceat(amplitudes, group_starts)
 
-        if sequence:  # Check that the sequence is not empty
-            amplitudes = [rms_transitions[index] for index in sequence]
-            max_amplitude_index = sequence[np.argmax(amplitudes)]
-            filtered_indices.append(max_amplitude_index)
+    # The first index reaching its group's maximum wins, like np.argmax
+    is_max = amplitudes == np.repeat(group_max, np.diff(np.append(group_starts, len(indices))))
+    _, first_max = np.unique(groups[is_max], return_index=True)
 
-    return filtered_indices
+    return list(indices[is_max][first_max])
 
 
 def get_cue_points_from_filtered_indices(filtered_indices, beats_or_downbeats):
@@ -0,0 +1,137 @@
+"""
+Batch rendering of short transition previews across worker processes.
+
+The audio of every source track is copied into shared memory once. Workers attach to
+it when they start, so only the small transition specs travel between processes:
+
+    specs = [{"track1": "Bours-", "track2": "JKS_AT_149bpm", "cue1": acue, "cue2": bcue,
+              "bass1": abass, "bass2": bbass} for acue, bcue, abass, bbass in candidates]
+    clips = render_previews({name: track.audio for name, track in tracks.items()}, specs, sr)
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from eq import bass_swap_envelopes, treble_swap_envelopes
+from instrumentation import span
+from mixing import MixBus, transition_decks
+
+# Source audio of the current worker, attached once by _attach_sources()
+_sources = {}
+_segments = []
+
+
+def _attach_sources(layout):
+    for name, (segment_name, length) in layout.items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        _segments.append(segment)
+        _sources[name] = np.ndarray(length, dtype=np.float32, buffer=segment.buf)
+
+
+def render_preview(sources, spec, sr, before=8.0, after=24.0):
+    """
+    Render the part of one transition around its cue point.
+
+    Args:
+        sources: A dict mapping track names to their audio.
+        spec: A dict with "track1", "track2", "cue1" and "cue2" as for transition_decks().
+            Optional "bass1" and "bass2" add a bass swap, optional "treble1", "treble2"
+            and "treble_duration" a treble swap, all in each track's own time.
+        sr: The sample rate.
+        before: Seconds of the mix before the cue point.
+        after: Seconds of the mix after the cue point.
+
+    Returns:
+        The preview as a float32 array.
+    """
+    eq1, eq2 = [], []
+    if "bass1" in spec:
+        bass1, bass2 = bass_swap_envelopes(spec["bass1"], spec["bass2"])
+        eq1.append(bass1)
+        eq2.append(bass2)
+    if "treble1" in spec:
+        treble1, treble2 = treble_swap_envelopes(spec["treble1"], spec["treble2"], spec["treble_duration"])
+        eq1.append(treble1)
+        eq2.append(treble2)
+
+    decks = transition_decks(sources[spec["track1"]], sources[spec["track2"]], spec["cue1"], spec["cue2"], sr,
+                             eq1=eq1 or None, eq2=eq2 or None)
+    bus = MixBus(decks)
+
+    # Only the preview window is mixed, the decks seek straight to it
+    start = max(0, int((spec["cue1"] - before) * sr))
+    end = min(bus.end, int((spec["cue1"] + after) * sr))
+    clip = np.empty(max(0, end - start), dtype=np.float32)
+    for position in range(start, end, bus.block_size):
+        bus.mix_into(clip[position - start:position - start + bus.block_size], position)
+    return clip
+
+
+def _render_job(job):
+    index, spec, sr, before, after, output_dir = job
+    clip = render_preview(_sources, spec, sr, before, after)
+    if output_dir is None:
+        return clip
+
+    import soundfile as sf
+
+    path = os.path.join(output_dir, f"preview_{index:04d}.wav")
+    sf.write(path, clip, sr, subtype="FLOAT")
+    return path
+
+
+def render_previews(sources, specs, sr, workers=None, before=8.0, after=24.0, output_dir=None):
+    """
+    Render many transition previews in a process pool.
+
+    Args:
+        sources: A dict mapping track names to their audio.
+        specs: Transition specs as described in render_preview().
+        sr: The sample rate.
+        workers: Number of worker processes, defaults to the number of CPUs. 0 renders
+            in this process.
+        before: Seconds of the mix before each cue point.
+        after: Seconds of the mix after each cue point.
+        output_dir: If given, each preview is written there as a WAV file and its path
+            is returned instead of the samples.
+
+    Returns:
+        A list with one preview clip or file path per spec, in the order of the specs.
+    """
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Only the tracks that some spec uses are shared
+    names = {spec[key] for spec in specs for key in ("track1", "track2")}
+
+    with span("previews.render_previews", previews=len(specs), tracks=len(names)):
+        if workers == 0:
+            _sources.update({name: sources[name] for name in names})
+            try:
+                return [_render_job((index, spec, sr, before, after, output_dir))
+                        for index, spec in enumerate(specs)]
+            finally:
+                _sources.clear()
+
+        segments = []
+        try:
+            layout = {}
+            for name in names:
+                audio = np.asarray(sources[name], dtype=np.float32)
+                segment = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+                segments.append(segment)
+                np.ndarray(len(audio), dtype=np.float32, buffer=segment.buf)[:] = audio
+                layout[name] = (segment.name, len(audio))
+
+            jobs = [(index, spec, sr, before, after, output_dir) for index, spec in enumerate(specs)]
+            workers = workers or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_sources, initargs=(layout,)) as pool:
+                # Batches of specs per task keep the per-task overhead low
+                return list(pool.map(_render_job, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+        finally:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
@@ -1,18 +1,21 @@
 """Tempo-related functions."""
 
-import librosa
-import pyrubberband as pyrb
-import soundfile as sf
+from collections import OrderedDict
+
+import numpy as np
+from instrumentation import span
+from preprocessing import refine_beats
 from track import Track, preprocess
 
 
-def adjust_tempo_pyrb(input_file, output_file, tempo_ratio):
-    """Adjust the tempo of an audio file and save the result to a new file."""
-    # Load the audio
-    audio, sr = librosa.load(input_file, sr=44100)
+def adjust_tempo_pyrb(audio, sr, output_file, tempo_ratio):
+    """Adjust the tempo of an audio signal and save the result to a new file."""
+    import pyrubberband as pyrb
+    import soundfile as sf
 
     # Time stretch the audio
-    audio_adjusted = pyrb.time_stretch(audio, sr, tempo_ratio)
+    with span("tempo.adjust_tempo_pyrb", samples=len(audio), ratio=tempo_ratio):
+        audio_adjusted = pyrb.time_stretch(audio, sr, tempo_ratio)
 
     # Write the adjusted audio to a .wav file
     sf.write(output_file, audio_adjusted, sr)
@@ -20,6 +23,107 @@ def adjust_tempo_pyrb(input_file, output_file, tempo_ratio):
     return audio_adjusted, output_file
 
 
+class StretchCache:
+    """Least recently used cache of stretched audio, bounded by the total size of the arrays."""
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        """Return the cached array for a key, or None on a miss."""
+        audio = self.entries.get(key)
+        if audio is not None:
+            self.entries.move_to_end(key)
+        return audio
+
+    def put(self, key, audio):
+        """Store an array, evicting the least recently used entries to stay within max_bytes."""
+        if key in self.entries:
+            self.size -= self.entries.pop(key).nbytes
+        self.entries[key] = audio
+        self.size += audio.nbytes
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+# Shared by every call to time_stretch unless another cache is passed in
+stretch_cache = StretchCache()
+
+
+def stretch_region(audio, sr, tempo_ratio, start_sample, end_sample, margin=0.5, key=None, cache=stretch_cache):
+    """
+    Time-stretch samples [start_sample, end_sample) of a signal.
+
+    Regions cut at the same boundaries tile the stretched timeline without gaps, so
+    a signal can be stretched in consecutive pieces.
+
+    Returns:
+        A tuple (offset, region): the stretched samples and the index on the stretched
+        timeline where they start.
+    """
+    margin_samples = int(margin * sr)
+    offset = int(round(start_sample / tempo_ratio))
+
+    cache_key = (key, tempo_ratio, start_sample, end_sample, margin_samples)
+    region = cache.get(cache_key) if key is not None else None
+
+    if region is None:
+        import pyrubberband as pyrb
+
+        with span("tempo.time_stretch", samples=end_sample - start_sample, ratio=tempo_ratio):
+            # Stretch the region plus its margins, then cut the margins off again
+            lo = max(0, start_sample - margin_samples)
+            hi = min(len(audio), end_sample + margin_samples)
+            stretched = pyrb.time_stretch(np.asarray(audio[lo:hi]), sr, tempo_ratio)
+            trim = int(round((start_sample - lo) / tempo_ratio))
+            length = int(round(end_sample / tempo_ratio)) - offset
+            region = stretched[trim:trim + length].astype(np.float32)
+
+        if key is not None:
+            cache.put(cache_key, region)
+
+    return offset, region
+
+
+def time_stretch(audio, sr, tempo_ratio, start=0.0, end=None, margin=0.5, key=None, cache=stretch_cache):
+    """
+    Time-stretch the part of a signal between `start` and `end`.
+
+    Args:
+        audio: The signal to stretch.
+        sr: The sample rate.
+        tempo_ratio: The stretch factor, above 1 speeds the signal up.
+        start: Start of the region to stretch, in seconds of the original signal.
+        end: End of the region, defaults to the end of the signal.
+        margin: Extra seconds stretched on both sides and then dropped, so the
+            region is free of edge effects.
+        key: Identifies the signal in the cache, e.g. the track's content hash.
+            Without a key nothing is cached.
+        cache: The StretchCache to use.
+
+    Returns:
+        The whole signal on the stretched timeline. Only the stretched region holds
+        audio, the rest is zeros.
+    """
+    start_sample = int(start * sr)
+    end_sample = len(audio) if end is None else min(int(end * sr), len(audio))
+    offset, region = stretch_region(audio, sr, tempo_ratio, start_sample, end_sample, margin, key, cache)
+
+    # The untouched zeros are never written, so they cost no memory until used
+    output = np.zeros(int(round(len(audio) / tempo_ratio)), dtype=np.float32)
+    region = region[:len(output) - offset]
+    output[offset:offset + len(region)] = region
+
+    return output
+
+
 def calculate_tempo_ratio(master, slave):
     """Calculate the tempo ratio between a master track and a slave track."""
     ratio = master.tempo / slave.tempo
@@ -30,25 +134,68 @@ def calculate_tempo_ratio(master, slave):
     return ratio
 
 
-def adjust_tempo_and_analyze(master_key, slave_key, tracks_dict):
-    """Adjust the tempo of a slave track to match a master track and analyze the result."""
+def warp_analysis(analysis, tempo_ratio):
+    """Map the analysis of a track onto the same track time-stretched by tempo_ratio."""
+    warped = dict(analysis)
+
+    # Stretching by the ratio divides every time stamp by it, indices into the grids do not change
+    downbeats = np.array(analysis["downbeats"], dtype=np.float64)
+    downbeats[:, 0] /= tempo_ratio
+    warped["downbeats"] = downbeats
+    warped["beats"] = np.asarray(analysis["beats"]) / tempo_ratio
+    warped["cue_points_rms"] = np.asarray(analysis["cue_points_rms"]) / tempo_ratio
+    warped["downbeat_differences"] = np.asarray(analysis["downbeat_differences"]) / tempo_ratio
+    warped["tempo"] = round(analysis["tempo"] * tempo_ratio)
+
+    return warped
+
+
+def refine_analysis(track):
+    """Snap the warped beat and downbeat grids of a track to nearby onsets and update its cue points."""
+    track.beats = refine_beats(track.audio, track.sr, track.beats)
+    track.downbeats = track.downbeats.copy()
+    track.downbeats[:, 0] = refine_beats(track.audio, track.sr, track.downbeats[:, 0])
+    track.cue_points_rms = track.beats[track.filtered_indices_rms]
+
+
+def adjust_tempo_and_analyze(master_key, slave_key, tracks_dict, cache=None, reanalyse=False, refine=False,
+                             start=0.0, end=None):
+    """
+    Adjust the tempo of a slave track to match a master track and analyze the result.
+
+    By default the slave's existing analysis is warped onto the stretched audio, which
+    is exact up to the stretcher's accuracy. `refine` adds a cheap pass that snaps the
+    warped grids to nearby onsets, `reanalyse` writes the stretched track to disk and
+    runs the full preprocess() instead.
+
+    Without `reanalyse` the slave is stretched in memory, and only between `start` and
+    `end` (seconds of the original slave), the rest of the adjusted audio is silent.
+    Stretched regions are cached, so rendering the same transition again is free.
+    """
     master = tracks_dict[master_key]
     slave = tracks_dict[slave_key]
 
     # Calculate the tempo ratio
     tempo_ratio = calculate_tempo_ratio(master, slave)
 
-    # Adjust the tempo of the slave track using pyrubberband
-    adjusted_audio, output_file = adjust_tempo_pyrb(
-        slave.wav_file, f"{slave_key}_AT_{master.tempo}bpm.wav", tempo_ratio)
-
-    # Create a new Track instance for the adjusted audio
-    adjusted_slave = Track(f"{slave_key}_AT_{master.tempo}bpm", output_file)
+    if reanalyse:
+        # Adjust the tempo of the slave track using pyrubberband
+        adjusted_audio, output_file = adjust_tempo_pyrb(
+            slave.audio, slave.sr, f"{slave_key}_AT_{master.tempo}bpm.wav", tempo_ratio)
+
+        # Create a new Track instance for the adjusted audio and preprocess it
+        adjusted_slave = Track(f"{slave_key}_AT_{master.tempo}bpm", output_file)
+        preprocess(adjusted_slave, cache=cache)
+    else:
+        # Stretch only the part of the slave that is played, and reuse its analysis mapped to the new tempo
+        adjusted_audio = time_stretch(slave.audio, slave.sr, tempo_ratio, start=start, end=end,
+                                      key=slave.content_hash)
+        adjusted_slave = Track(f"{slave_key}_AT_{master.tempo}bpm", None, audio=adjusted_audio, sr=slave.sr)
+        adjusted_slave.load_analysis(warp_analysis(slave.analysis(), tempo_ratio))
+        if refine:
+            refine_analysis(adjusted_slave)
 
     # Add the adjusted track to the tracks dictionary
     tracks_dict[f"{slave_key}_AT_{master.tempo}bpm"] = adjusted_slave
 
-    # Preprocess the adjusted track
-    preprocess(adjusted_slave)
-
     return adjusted_slave
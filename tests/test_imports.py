@@ -0,0 +1,32 @@
+"""Importing the pipeline must stay cheap: the audio backends load only when a stage needs them."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds allowed for the import in a fresh interpreter, numpy included
+IMPORT_BUDGET = 1.0
+
+HEAVY_MODULES = ("librosa", "madmom", "essentia", "scipy.signal")
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+@pytest.mark.parametrize("module", ["track", "main"])
+def test_import_is_light(module):
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    seconds, loaded = result.stdout.splitlines()
+
+    assert loaded == "", f"importing {module} loaded {loaded}"
+    assert float(seconds) < IMPORT_BUDGET, f"importing {module} took {float(seconds):.2f} s"
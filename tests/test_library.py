@@ -0,0 +1,24 @@
+"""Track IDs kept across rescans of a library folder."""
+
+import os
+
+from library import Library
+
+
+def test_moved_duplicates_keep_their_ids(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / f"{name}.wav").write_bytes(b"same contents")
+    (tmp_path / "d.wav").write_bytes(b"other contents")
+    assert Library(str(tmp_path)).scan() == (["a", "b", "c", "d"], [], [])
+
+    # Two of three identical files are renamed, the third is deleted
+    os.rename(tmp_path / "a.wav", tmp_path / "x.wav")
+    os.rename(tmp_path / "b.wav", tmp_path / "y.wav")
+    os.remove(tmp_path / "c.wav")
+
+    library = Library(str(tmp_path))
+    added, changed, removed = library.scan()
+    assert (added, changed) == ([], [])
+    assert len(removed) == 1
+    assert sorted(library.entries) == sorted({"a", "b", "c", "d"} - set(removed))
+    assert sorted(os.path.basename(entry["path"]) for entry in library.entries.values()) == ["d.wav", "x.wav", "y.wav"]
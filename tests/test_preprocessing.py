@@ -0,0 +1,111 @@
+"""The vectorised cue-point helpers against the loops they replaced."""
+
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+import pytest
+
+from preprocessing import calculate_rms_transitions_indices, filter_consecutive_indices
+
+SR = 44100
+HOP_LENGTH = 512
+
+
+def loop_rms_transitions_indices(rms, sr, beats, hop_length=HOP_LENGTH, percentile=97.5):
+    """The original per-beat loop, taking the frame RMS directly."""
+    librosa = pytest.importorskip("librosa")
+
+    rms_transitions = []
+    transition_indices = []
+    for i in range(len(beats)):
+        prev_frame = int(librosa.time_to_samples(beats[i-1], sr=sr) / hop_length) if i > 0 else None
+        current_frame = int(librosa.time_to_samples(beats[i], sr=sr) / hop_length)
+        next_frame = int(librosa.time_to_samples(beats[i+1], sr=sr) / hop_length) if i < len(beats) - 1 else None
+
+        if prev_frame is not None and next_frame is not None:
+            rms_transition = max(np.abs(rms[current_frame] - rms[prev_frame]),
+                                 np.abs(rms[current_frame] - rms[next_frame]))
+        elif prev_frame is not None:
+            rms_transition = np.abs(rms[current_frame] - rms[prev_frame])
+        else:
+            rms_transition = np.abs(rms[current_frame] - rms[next_frame])
+
+        rms_transitions.append(rms_transition)
+        transition_indices.append(i)
+
+    rms_transitions = np.array(rms_transitions)
+    transition_indices = np.array(transition_indices)
+    top_rms_indices = transition_indices[rms_transitions >= np.percentile(rms_transitions, percentile)]
+    return np.append(0, top_rms_indices), rms_transitions
+
+
+def loop_filter_consecutive_indices(indices, rms_transitions):
+    """The original groupby loop."""
+    if len(indices) <= 4:
+        return indices
+
+    filtered_indices = []
+    for _, group in groupby(enumerate(indices), lambda ix: ix[0] - ix[1]):
+        sequence = sorted(map(itemgetter(1), group))
+        sequence = [index for index in sequence if index < len(rms_transitions)]
+        if sequence:
+            amplitudes = [rms_transitions[index] for index in sequence]
+            filtered_indices.append(sequence[np.argmax(amplitudes)])
+    return filtered_indices
+
+
+def random_case(rng, quantised):
+    n_frames = int(rng.integers(200, 3000))
+    rms = rng.random(n_frames).astype(np.float32)
+    if quantised:
+        # Few distinct levels give equal transitions, including at the percentile
+        rms = (np.round(rms * 3) / 3).astype(np.float32)
+
+    duration = (n_frames - 1) * HOP_LENGTH / SR
+    n_beats = int(rng.integers(3, 200))
+    beats = np.sort(rng.uniform(0, duration, n_beats))
+    return rms, beats
+
+
+@pytest.mark.parametrize("seed", range(40))
+@pytest.mark.parametrize("quantised", [False, True])
+def test_rms_transitions_match_loop(seed, quantised):
+    rng = np.random.default_rng(seed)
+    rms, beats = random_case(rng, quantised)
+    percentile = float(rng.choice([50, 90, 97.5]))
+
+    indices, transitions = calculate_rms_transitions_indices(None, SR, beats, hop_length=HOP_LENGTH,
+                                                             percentile=percentile, rms=rms)
+    expected_indices, expected_transitions = loop_rms_transitions_indices(rms, SR, beats, percentile=percentile)
+
+    np.testing.assert_array_equal(transitions, expected_transitions)
+    np.testing.assert_array_equal(indices, expected_indices)
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_filter_consecutive_indices_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(5, 300))
+    # Coarse amplitudes so runs often contain ties
+    transitions = np.round(rng.random(n) * 4) / 4
+
+    # Sorted indices made of runs of consecutive beats, some past the end of the transitions
+    starts = np.sort(rng.choice(n + 10, size=min(n, int(rng.integers(5, 40))), replace=False))
+    runs = [np.arange(start, start + rng.integers(1, 6)) for start in starts]
+    indices = np.unique(np.concatenate(runs))
+    indices = np.append(0, indices)
+
+    result = filter_consecutive_indices(indices, transitions)
+    expected = loop_filter_consecutive_indices(indices, transitions)
+    assert [int(i) for i in result] == [int(i) for i in expected]
+
+
+def test_pipeline_matches_loop_on_ties():
+    rng = np.random.default_rng(123)
+    for _ in range(20):
+        rms, beats = random_case(rng, quantised=True)
+        indices, transitions = calculate_rms_transitions_indices(None, SR, beats, rms=rms)
+        expected_indices, expected_transitions = loop_rms_transitions_indices(rms, SR, beats)
+        assert ([int(i) for i in filter_consecutive_indices(indices, transitions)]
+                == [int(i) for i in loop_filter_consecutive_indices(expected_indices, expected_transitions)])
@@ -1,19 +1,43 @@
-import librosa
+import hashlib
+
+import numpy as np
+from cache import analysis_key, file_hash
+from features import compute_features, features_key
+from instrumentation import span
+from visualisations import waveform_overview
 from preprocessing import (
     calculate_beats_multifeature,
+    calculate_beats_multifeature_windowed,
     detect_downbeats,
+    detect_downbeats_windowed,
     estimate_tempo_from_downbeats,
     calculate_rms_transitions_indices,
     filter_consecutive_indices,
     get_cue_points_from_filtered_indices
 )
 
+# Attributes filled in by preprocess(), in the order they are computed
+ANALYSIS_FIELDS = (
+    "downbeats",
+    "tempo",
+    "downbeat_differences",
+    "beats",
+    "filtered_indices_rms",
+    "cue_points_rms",
+    "cue_point_counts",
+)
+
 
 class Track:
-    def __init__(self, name, wav_file):
+    def __init__(self, name, wav_file, audio=None, sr=44100, cache=None, content_hash=None):
         self.name = name
         self.wav_file = wav_file
-        self.audio, self.sr = librosa.load(wav_file, sr=44100)
+        self.sr = sr
+        # Optional AnalysisCache that keeps decoded audio for memory-mapping
+        self.cache = cache
+        # Audio that is already in memory, e.g. a time-stretched copy of another track,
+        # otherwise the file is decoded on first access of `audio`
+        self._audio = audio
         self.tempo = None
         self.downbeats = None
         self.cue_points_rms = None
@@ -21,20 +45,165 @@ class Track:
         self.filtered_indices_rms = None
         self.downbeat_differences = None
         self.cue_point_counts = None
+        # Frame-level feature columns, see features.compute_features()
+        self.features = None
+        # Known up front when the track comes from a Library index
+        self._content_hash = content_hash
+        self._overview = None
+
+    @property
+    def audio(self):
+        """The mono float32 samples, loaded on first access."""
+        if self._audio is None:
+            with span("track.load_audio", track=self.name) as s:
+                self._audio = self._load_audio()
+                s.add(samples=len(self._audio))
+        return self._audio
+
+    def _load_audio(self):
+        if self.cache is not None:
+            # Memory-map the samples decoded on an earlier run
+            audio = self.cache.load_audio(self.content_hash, self.sr)
+            if audio is not None:
+                return audio
+
+            # Stream straight into the cache when no resampling is needed
+            audio = self._decode_into_cache()
+            if audio is not None:
+                return audio
+
+        # Decode once, every analysis stage reads this buffer
+        import librosa
+
+        audio, _ = librosa.load(self.wav_file, sr=self.sr, mono=True, dtype=np.float32)
+
+        if self.cache is not None:
+            # Keep the raw samples on disk and only page in what is used
+            self.cache.put_audio(self.content_hash, self.sr, audio)
+            return self.cache.load_audio(self.content_hash, self.sr)
+        return audio
+
+    def _decode_into_cache(self, block_size=1 << 20):
+        # Long recordings are decoded block by block, so they are never in memory whole
+        import soundfile as sf
+
+        try:
+            info = sf.info(self.wav_file)
+        except RuntimeError:
+            # Formats libsndfile cannot read are streamed through audioread
+            native_sr, length, blocks = _audioread_blocks(self.wav_file, block_size)
+            exact = False
+        else:
+            native_sr, length, exact = info.samplerate, info.frames, True
+            blocks = (block.mean(axis=1) for block in
+                      sf.blocks(self.wav_file, blocksize=block_size, dtype="float32", always_2d=True))
+
+        if native_sr != self.sr:
+            blocks = _resampled_blocks(blocks, native_sr, self.sr)
+            # Same length as librosa.load() would give
+            length = int(np.ceil(length * self.sr / native_sr))
+            exact = False
+        if not exact:
+            blocks = _fit_blocks(blocks, length)
+        return self.cache.put_audio_blocks(self.content_hash, self.sr, length, blocks)
 
-    def detect_downbeats(self):
-        self.downbeats = detect_downbeats(self.wav_file)
+    def release(self):
+        """Drop the audio of a file-backed track, it is loaded again on next access."""
+        if self.wav_file is not None:
+            self._audio = None
+
+    @property
+    def content_hash(self):
+        """SHA-1 of the source file, or of the samples for in-memory tracks, computed on first use."""
+        if self._content_hash is None:
+            if self.wav_file is None:
+                self._content_hash = hashlib.sha1(self.audio.tobytes()).hexdigest()
+            else:
+                self._content_hash = file_hash(self.wav_file)
+        return self._content_hash
+
+    @property
+    def duration(self):
+        """Length in seconds, read from the header or the cached samples rather than by decoding the file."""
+        if self._audio is None and self.wav_file is not None:
+            audio = self.cache.load_audio(self.content_hash, self.sr) if self.cache is not None else None
+            if audio is not None:
+                return len(audio) / self.sr
+
+            import soundfile as sf
+
+            try:
+                return sf.info(self.wav_file).duration
+            except RuntimeError:
+                # Formats libsndfile cannot read are decoded after all
+                pass
+        return len(self.audio) / self.sr
+
+    def waveform_overview(self):
+        """Min/max overview of the waveform for plotting, cached next to the analysis."""
+        if self._overview is None:
+            key = analysis_key(self.content_hash, overview=1) if self.cache is not None else None
+            if key is not None:
+                self._overview = self.cache.get(key)
+            if self._overview is None:
+                self._overview = waveform_overview(self.audio, self.sr)
+                if key is not None:
+                    self.cache.put(key, self._overview)
+        return self._overview
+
+    def analysis(self):
+        """Return the analysis results as a plain, picklable dict."""
+        return {field: getattr(self, field) for field in ANALYSIS_FIELDS}
+
+    def load_analysis(self, analysis):
+        """Restore analysis results previously returned by analysis()."""
+        for field in ANALYSIS_FIELDS:
+            setattr(self, field, analysis[field])
+
+    def detect_downbeats(self, fps=100, window=None, overlap=20.0):
+        with span("track.detect_downbeats", track=self.name, samples=len(self.audio)) as s:
+            if window is None:
+                self.downbeats = detect_downbeats(self.audio, self.sr, fps=fps)
+            else:
+                self.downbeats = detect_downbeats_windowed(self.audio, self.sr, fps=fps, window=window,
+                                                           overlap=overlap)
+            s.add(downbeats=len(self.downbeats))
 
     def estimate_tempo_from_downbeats(self):
-        self.tempo, _, self.downbeat_differences = estimate_tempo_from_downbeats(self.wav_file, self.downbeats)
+        with span("track.estimate_tempo_from_downbeats", track=self.name):
+            self.tempo, _, self.downbeat_differences = estimate_tempo_from_downbeats(self.wav_file, self.downbeats)
+
+    def calculate_beats_multifeature(self, window=None, overlap=20.0):
+        with span("track.calculate_beats_multifeature", track=self.name, samples=len(self.audio)) as s:
+            if window is None:
+                self.beats = calculate_beats_multifeature(self.audio)
+            else:
+                self.beats = calculate_beats_multifeature_windowed(self.audio, self.sr, window=window,
+                                                                   overlap=overlap)
+            s.add(beats=len(self.beats))
 
-    def calculate_beats_multifeature(self):
-        self.beats = calculate_beats_multifeature(self.wav_file)
+    def calculate_features(self, window_size=1024, hop_length=512, window=None):
+        with span("track.calculate_features", track=self.name, samples=len(self.audio)) as s:
+            chunk_frames = int(window * self.sr) // hop_length if window is not None else None
+            self.features = compute_features(self.audio, self.sr, self.beats, self.downbeats,
+                                             window_size=window_size, hop_length=hop_length,
+                                             chunk_frames=chunk_frames)
+            s.add(frames=len(self.features["rms"]))
 
-    def calculate_rms_transition_cue_points(self):
-        top_rms_indices, rms_transitions = calculate_rms_transitions_indices(self.audio, self.sr, self.beats)
-        self.filtered_indices_rms = filter_consecutive_indices(top_rms_indices, rms_transitions)
-        self.cue_points_rms = get_cue_points_from_filtered_indices(self.filtered_indices_rms, self.beats)
+    def calculate_rms_transition_cue_points(self, window_size=1024, hop_length=512, percentile=97.5):
+        # Reuse the frame RMS of the features when they were computed with the same frames
+        rms = None
+        if (self.features is not None and self.features["window_size"] == window_size
+                and self.features["hop_length"] == hop_length):
+            rms = self.features["rms"]
+
+        with span("track.calculate_rms_transition_cue_points", track=self.name, beats=len(self.beats)) as s:
+            top_rms_indices, rms_transitions = calculate_rms_transitions_indices(
+                self.audio if rms is None else None, self.sr, self.beats, window_size=window_size,
+                hop_length=hop_length, percentile=percentile, rms=rms)
+            self.filtered_indices_rms = filter_consecutive_indices(top_rms_indices, rms_transitions)
+            self.cue_points_rms = get_cue_points_from_filtered_indices(self.filtered_indices_rms, self.beats)
+            s.add(cue_points=len(self.cue_points_rms))
 
     def count_cue_points_in_all_beat_series(self):
         counts = [0, 0, 0, 0]
@@ -45,17 +214,135 @@ class Track:
         self.cue_point_counts = counts
 
 
-def preprocess(track):
-    track.detect_downbeats()
-    track.estimate_tempo_from_downbeats()
-    print(f"Tempo : {track.tempo}")
+def _audioread_blocks(path, block_size):
+    """Sample rate, approximate length and mono float32 blocks of a file decoded by audioread."""
+    import audioread
+
+    f = audioread.audio_open(path)
+    native_sr, channels = f.samplerate, f.channels
+
+    def blocks():
+        with f:
+            pending = []
+            pending_samples = 0
+            for buffer in f:
+                samples = np.frombuffer(buffer, dtype="<i2").astype(np.float32) / 32768
+                pending.append(samples.reshape(-1, channels).mean(axis=1))
+                pending_samples += len(pending[-1])
+                # The decoder's buffers are small, hand them on in blocks of `block_size`
+                if pending_samples >= block_size:
+                    yield np.concatenate(pending)
+                    pending = []
+                    pending_samples = 0
+            if pending:
+                yield np.concatenate(pending)
 
-    track.calculate_beats_multifeature()
-    track.calculate_rms_transition_cue_points()
-    track.count_cue_points_in_all_beat_series()
+    return native_sr, int(round(f.duration * native_sr)), blocks()
+
+
+def _resampled_blocks(blocks, native_sr, sr):
+    """Resample a stream of blocks with the same soxr filter librosa.load() uses, carrying its state."""
+    import soxr
+
+    stream = soxr.ResampleStream(native_sr, sr, 1, dtype="float32", quality="HQ")
+    for block in blocks:
+        out = stream.resample_chunk(np.asarray(block, dtype=np.float32))
+        if len(out):
+            yield out
+    yield stream.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+def _fit_blocks(blocks, length):
+    """Trim or zero-pad a stream of blocks to exactly `length` samples."""
+    written = 0
+    for block in blocks:
+        block = block[:length - written]
+        written += len(block)
+        if len(block):
+            yield block
+    if written < length:
+        yield np.zeros(length - written, dtype=np.float32)
+
+
+def preprocess(track, cache=None, fps=100, window_size=1024, hop_length=512, percentile=97.5, window=None,
+               overlap=20.0):
+    # With `window` (seconds) long recordings are analysed in overlapping windows of that length,
+    # so memory use is bounded by the window rather than the length of the file. That needs a cache
+    # to stream the decoded file into, without one the whole file would be decoded into memory.
+    if window is not None and cache is None and track._audio is None:
+        raise ValueError("Windowed analysis of a file needs a cache to decode it into")
+
+    with span("preprocess", track=track.name) as s:
+        cache_hit = _preprocess(track, cache, fps, window_size, hop_length, percentile, window, overlap)
+        s.add(cache_hits=int(cache_hit))
 
     print("Tempo:", track.tempo)
     print("Filtered Indices (RMS):", track.filtered_indices_rms)
     print("Cue Points (RMS):", track.cue_points_rms)
     print("Beat series : ", track.cue_point_counts)
     print()
+
+
+def load_cached_analysis(track, cache, fps=100, window_size=1024, hop_length=512, percentile=97.5, window=None,
+                         overlap=20.0):
+    """Restore a track's analysis from the cache without touching its audio, return whether it was there."""
+    cached = cache.get(_analysis_key(track, fps, window_size, hop_length, percentile, window, overlap))
+    if cached is not None:
+        track.load_analysis(cached)
+    return cached is not None
+
+
+def _window_params(window, overlap):
+    # Whole-file analysis keeps the keys it had before windowed analysis existed
+    return {} if window is None else {"window": window, "overlap": overlap}
+
+
+def _analysis_key(track, fps, window_size, hop_length, percentile, window, overlap):
+    # Entries are keyed on the file contents and every parameter that affects the result
+    return analysis_key(track.content_hash, fps=fps, window_size=window_size, hop_length=hop_length,
+                        percentile=percentile, **_window_params(window, overlap))
+
+
+def _preprocess(track, cache, fps, window_size, hop_length, percentile, window, overlap):
+    key = None
+    cached = None
+    if cache is not None:
+        key = _analysis_key(track, fps, window_size, hop_length, percentile, window, overlap)
+        cached = cache.get(key)
+
+    if cached is not None:
+        track.load_analysis(cached)
+        print(f"Loaded cached analysis for {track.name}")
+    else:
+        track.detect_downbeats(fps=fps, window=window, overlap=overlap)
+        track.estimate_tempo_from_downbeats()
+        print(f"Tempo : {track.tempo}")
+
+        track.calculate_beats_multifeature(window=window, overlap=overlap)
+        if cache is not None:
+            # Features cost a pass over the audio, so only when they are stored; the cue points reuse their RMS
+            _cached_features(track, cache, fps, window_size, hop_length, window, overlap)
+        elif window is not None:
+            # Computed window by window, so the RMS of a long recording never covers it whole at once
+            track.calculate_features(window_size=window_size, hop_length=hop_length, window=window)
+        track.calculate_rms_transition_cue_points(window_size=window_size, hop_length=hop_length,
+                                                  percentile=percentile)
+        track.count_cue_points_in_all_beat_series()
+
+        if cache is not None:
+            cache.put(key, track.analysis())
+
+    if cache is not None and track.features is None:
+        _cached_features(track, cache, fps, window_size, hop_length, window, overlap)
+
+    return cached is not None
+
+
+def _cached_features(track, cache, fps, window_size, hop_length, window, overlap):
+    # Keep the features next to the analysis so cue rules can be rerun without the audio
+    key = features_key(track.content_hash, fps=fps, window_size=window_size, hop_length=hop_length,
+                       **_window_params(window, overlap))
+    track.features = cache.load_features(key)
+    if track.features is None:
+        track.calculate_features(window_size=window_size, hop_length=hop_length, window=window)
+        cache.put_features(key, track.features)
@@ -1,14 +1,65 @@
-import matplotlib.pyplot as plt
 import numpy as np
 
+# Pixels across a 14-inch wide figure at matplotlib's default 100 dpi
+FIGURE_PIXELS = 1400
 
-def plot_waveform(audio, sr):
-    # Compute the time values for the waveform
-    times = np.linspace(0, len(audio) / sr, len(audio))
 
-    # Create a figure
+def waveform_overview(audio, sr, base_bucket=256, factor=4, min_buckets=512):
+    """
+    Compute a multi-resolution min/max overview of a waveform.
+
+    Level 0 holds the minimum and maximum of every `base_bucket` samples, each further
+    level merges `factor` buckets of the previous one, until fewer than `min_buckets`
+    remain. The overview is small and picklable, so it can be cached with the analysis.
+    """
+    n_full = len(audio) // base_bucket
+    body = np.asarray(audio[:n_full * base_bucket]).reshape(n_full, base_bucket)
+    mins = body.min(axis=1)
+    maxs = body.max(axis=1)
+
+    # The last partial bucket
+    if len(audio) > n_full * base_bucket:
+        tail = np.asarray(audio[n_full * base_bucket:])
+        mins = np.append(mins, tail.min())
+        maxs = np.append(maxs, tail.max())
+
+    levels = [(base_bucket, mins, maxs)]
+    bucket = base_bucket
+    while len(mins) > min_buckets:
+        # Repeat the last bucket so the level divides evenly
+        pad = -len(mins) % factor
+        mins = np.pad(mins, (0, pad), mode="edge").reshape(-1, factor).min(axis=1)
+        maxs = np.pad(maxs, (0, pad), mode="edge").reshape(-1, factor).max(axis=1)
+        bucket *= factor
+        levels.append((bucket, mins, maxs))
+
+    return {"sr": sr, "length": len(audio), "levels": levels}
+
+
+def _overview_level(overview, pixels):
+    # The coarsest level that still has two buckets per pixel
+    for level in reversed(overview["levels"]):
+        if len(level[1]) >= 2 * pixels:
+            return level
+    return overview["levels"][0]
+
+
+def _plot_overview(plt, audio, sr, overview):
+    if overview is None:
+        overview = waveform_overview(audio, sr)
+    bucket, mins, maxs = _overview_level(overview, FIGURE_PIXELS)
+
+    # Draw the envelope of each bucket rather than one point per sample
+    times = (np.arange(len(mins)) + 0.5) * bucket / overview["sr"]
+    plt.fill_between(times, mins, maxs, alpha=0.6, linewidth=0)
+
+
+def plot_waveform(audio, sr, overview=None):
+    import matplotlib.pyplot as plt
+
+    # Create a figure, drawn from the overview (computed here if not given)
     plt.figure(figsize=(14, 5))
-    plt.plot(times, audio, alpha=0.6)
+    _plot_overview(plt, audio, sr, overview)
     plt.ylim(-1, 1)
     plt.xlabel('Time (s)')
     plt.ylabel('Amplitude')
@@ -16,14 +67,12 @@ def plot_waveform(audio, sr):
     plt.show()
 
 
-def plot_waveform_with_hot_cues(audio, sr, hot_cues):
-    # Create a time array for the waveform
-    duration = len(audio) / sr
-    times = np.linspace(0, duration, len(audio))
+def plot_waveform_with_hot_cues(audio, sr, hot_cues, overview=None):
+    import matplotlib.pyplot as plt
 
-    # Create the plot
+    # Create the plot, drawn from the overview (computed here if not given)
     plt.figure(figsize=(14, 5))
-    plt.plot(times, audio, alpha=0.6)
+    _plot_overview(plt, audio, sr, overview)
 
     # Plot the hot cues as vertical lines
     for hot_cue in hot_cues: